@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Module for controlled execution of bot commands.
+
+Classes:
+    CommandLimits       --- Execution limits of a command.
+    TokenBucket         --- Token bucket rate limiter.
+    CommandExecutor     --- Runs command callbacks with timeouts, concurrency caps and rate limits.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+__version__ = "0.5.0"
+
+from collections import namedtuple
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CommandLimits = namedtuple("CommandLimits", "timeout concurrency")
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Attributes:
+        rate        --- Number of tokens added per second.
+        burst       --- Maximum number of tokens in the bucket.
+        tokens      --- Current number of tokens.
+
+    Methods:
+        consume     --- Try to take tokens from the bucket.
+        is_full     --- Test if the bucket is (or would be) full.
+
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Arguments:
+            rate        --- Number of tokens added per second.
+            burst       --- Maximum number of tokens in the bucket.
+
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._stamp = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def consume(self, tokens=1):
+        """
+        Try to take tokens from the bucket, return True on success.
+
+        Keyworded arguments:
+            tokens      --- Number of tokens to take.
+
+        """
+        self._refill(time.time())
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def is_full(self):
+        """
+        Test if the bucket is (or would be after refill) full.
+
+        """
+        self._refill(time.time())
+        return self.tokens >= self.burst
+
+
+class CommandExecutor:
+    """
+    Runs command callbacks with timeouts, concurrency caps and per-user rate limits.
+
+    Attributes:
+        default_limits  --- CommandLimits used for commands without specific settings.
+        limits          --- Dictionary with CommandLimits of commands.
+
+    Methods:
+        configure       --- Set global and per-command limits.
+        execute         --- Execute the command callback within the limits.
+
+    """
+
+    _max_buckets = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.default_limits = CommandLimits(0, 0)
+        self.limits = {}
+        self._rate = 0
+        self._burst = 1
+        self._concurrency = 0
+        self._running = 0
+        self._running_commands = {}
+        self._buckets = {}
+
+    def configure(self, concurrency=0, rate=0, burst=1, default_limits=None, limits=None):
+        """
+        Set global and per-command limits.
+
+        Keyworded arguments:
+            concurrency     --- Maximum number of commands running at the same time (0 for unlimited).
+            rate            --- Number of commands per second a single user may issue in the long run (0 for unlimited).
+            burst           --- Number of commands a single user may issue in a quick succession.
+            default_limits  --- CommandLimits used for commands without specific settings.
+            limits          --- Dictionary with CommandLimits of commands.
+
+        """
+        with self.lock:
+            self._concurrency = max(0, concurrency)
+            if (rate, burst) != (self._rate, self._burst):
+                self._buckets = {}
+            self._rate = max(0, rate)
+            self._burst = max(1, burst)
+            self.default_limits = default_limits or CommandLimits(0, 0)
+            self.limits = dict(limits or {})
+
+    def execute(self, name, callback, args=(), user=None, reply=None):
+        """
+        Execute the command callback within the limits.
+        Without reply, wait for the command and return the callback result, or None if the command was rejected,
+        failed or timed out. With reply, return immediately, reply is called with the result from the command thread.
+        A timed out command keeps running in the background and holds its concurrency slots until it ends,
+        its result is dropped.
+
+        Arguments:
+            name        --- Name of the command.
+            callback    --- Command callback.
+
+        Keyworded arguments:
+            args        --- Arguments passed to the callback.
+            user        --- Key identifying the user for rate limiting (e.g. JID string).
+            reply       --- Function called with the callback result (only if the command finished in time).
+
+        """
+        limits = self.limits.get(name, self.default_limits)
+        with self.lock:
+            if self._concurrency > 0 and self._running >= self._concurrency:
+                log.warn(_("Too many commands running, ignoring command {!r}.").format(name))
+                return None
+            running = self._running_commands.get(name, 0)
+            if limits.concurrency > 0 and running >= limits.concurrency:
+                log.warn(_("Too many instances of command {!r} running, ignoring it.").format(name))
+                return None
+            # Rejected commands do not cost the user a token
+            if not self._check_rate(user):
+                log.info(_("Rate limit of user {} exceeded, ignoring command {!r}.").format(user, name))
+                return None
+            self._running += 1
+            self._running_commands[name] = running + 1
+
+        result = []
+        start = time.time()
+        def target():
+            try:
+                result.append(callback(*args))
+            except:
+                log.exception(_("Command {!r} FAILED.").format(name))
+            finally:
+                self._release(name)
+            if reply is None or len(result) == 0:
+                return
+            if limits.timeout > 0 and time.time() - start > limits.timeout:
+                log.error(_("Command {!r} timed out after {} seconds.").format(name, limits.timeout))
+                return
+            try:
+                reply(result[0])
+            except:
+                log.exception(_("Reply to command {!r} FAILED.").format(name))
+
+        if limits.timeout <= 0:
+            target()
+        else:
+            thread = threading.Thread(target=target, name="command_{}".format(name))
+            thread.daemon = True
+            thread.start()
+            if reply is not None:
+                return None
+            thread.join(limits.timeout)
+            if thread.is_alive():
+                log.error(_("Command {!r} timed out after {} seconds.").format(name, limits.timeout))
+                return None
+
+        if reply is not None:
+            return None
+
+        if len(result) == 0:
+            return None
+        return result[0]
+
+    def _release(self, name):
+        with self.lock:
+            self._running -= 1
+            self._running_commands[name] -= 1
+            if self._running_commands[name] <= 0:
+                del self._running_commands[name]
+
+    def _check_rate(self, user):
+        """ Consume a token from user's bucket, must be called with lock held """
+        if user is None or self._rate <= 0:
+            return True
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            if len(self._buckets) >= self._max_buckets:
+                # Forget users that would have a full bucket anyway
+                for key in [key for key, item in self._buckets.items() if item.is_full()]:
+                    del self._buckets[key]
+            bucket = self._buckets[user] = TokenBucket(self._rate, self._burst)
+        return bucket.consume()
@@ -19,7 +19,8 @@ __license__ = "GPL 3.0"
 
 __version__ = "0.5.0"
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from copy import deepcopy
 import gettext as gt
 from imp import reload
 import logging
@@ -27,18 +28,23 @@ from optparse import IndentedHelpFormatter, OptionGroup, OptionParser
 import os.path
 import sys
 import threading
+import time
 from time import sleep
 from types import ModuleType
 from xml.etree import cElementTree as ET
 
 sys.path.insert(0, os.path.join(sys.path[0], "libs"))
 
+_core_import_start = time.time()
 import colterm
+from execution import CommandExecutor, CommandLimits
+from maintenance import Maintenance, RetentionPolicy
 import plugins
 import sleekxmpp
 from sleekxmpp.xmlstream import JID
 from storage import Storage
 from versioning import python_version
+_core_import_time = time.time() - _core_import_start
 
 # Global gettext translation for console output etc.
 _localedir = os.path.join(os.path.dirname(__file__), "locale")
@@ -103,11 +109,18 @@ class BaseBot(sleekxmpp.ClientXMPP):
         auth                --- Authentication data.
         cmd_prefix          --- Prefix used for commands.
         bot_plugins         --- Bot's plugins.
+        bot_plugin_configs  --- Configuration of registered bot plugins as tuple (module, config).
+        bot_plugin_items    --- Commands and help topics registered by bot plugins.
         store               --- Persistent Storage object.
+        maintenance         --- Maintenance service of the store.
         permissions         --- Command access levels.
+        command_levels      --- Resolved access levels of registered commands.
+        registry_version    --- Counter incremented on every change of commands, help topics or permissions.
+        executor            --- CommandExecutor running the command callbacks.
         commands            --- Registered commands.
         help_topics         --- Registered help topics.
         translations        --- Dictionary with gettext translations.
+        startup_profile     --- List of (plugin type, name, import seconds, init seconds), None if not profiling.
         users               --- List of User instances.
         default_user        --- Default UserConfig.
 
@@ -118,8 +131,12 @@ class BaseBot(sleekxmpp.ClientXMPP):
         handle_session_end      --- Handler for session_end event.
         handle_killed           --- Handler for killed event.
         handle_message          --- Handler for message event.
+        send_response           --- Send the response of a command.
+        register_plugin         --- Register and configure a SleekXMPP plugin.
         get_our_nick            --- Get our nick in MUC room.
+        get_real_jid            --- Get real JID of the user (if known).
         get_command_level       --- Get required access level for the command.
+        get_registry_version    --- Get current value of registry_version counter.
         get_user_config         --- Get UserConfig corresponding to the given JID.
         register_bot_plugin     --- Register and configure a bot plugin.
         deregister_bot_plugins  --- Deregister all registered bot plugins.
@@ -134,13 +151,21 @@ class BaseBot(sleekxmpp.ClientXMPP):
 
     cmd_prefix = "!"
     bot_plugins = {}
+    bot_plugin_configs = {}
+    bot_plugin_items = {}
     store = None
+    maintenance = None
     permissions = {}
+    command_levels = {}
+    registry_version = 0
+    executor = None
     commands = {}
     help_topics = {}
     translations = {}
+    startup_profile = None
     users = []
     default_user = UserConfig(0, "en")
+    _registering_plugin = None
 
     def __init__(self, auth):
         """
@@ -178,6 +203,10 @@ class BaseBot(sleekxmpp.ClientXMPP):
         """
         log.warn(_("Disconnecting the bot."))
         self.deregister_bot_plugins()
+        if self.maintenance is not None:
+            self.maintenance.stop()
+        if self.store is not None:
+            self.store.shutdown()
         self.disconnect()
 
     def event(self, name, data={}, direct=False):
@@ -254,7 +283,29 @@ class BaseBot(sleekxmpp.ClientXMPP):
         if args.startswith(" "):
             args = args[1:]
         log.debug(_("Command {!r} with args {!r}").format(command, args))
-        response = self.commands[command](command, args, msg, user_config)
+        callback_args = (command, args, msg, user_config)
+        reply = lambda response: self.send_response(msg, response)
+        if self.executor is None:
+            reply(self.commands[command](*callback_args))
+        else:
+            user = self.get_real_jid(msg["from"])
+            if user.full == msg["from"].full and self.get_our_nick(user.bare) is not None:
+                # Anonymous MUC occupant
+                user = user.full
+            else:
+                user = user.bare
+            # The response is sent from the command thread, do not block the event handler thread
+            self.executor.execute(command, self.commands[command], callback_args, user, reply)
+
+    def send_response(self, msg, response):
+        """
+        Send the response of a command.
+
+        Arguments:
+            msg         --- Message stanza with the command.
+            response    --- Response text (None or empty for no response).
+
+        """
         if response in (None, ""):
             # No response
             return
@@ -263,6 +314,33 @@ class BaseBot(sleekxmpp.ClientXMPP):
             response = "{}: {}".format(msg["mucnick"], response)
         msg.reply(response).send()
 
+    def register_plugin(self, plugin, pconfig={}, module=None):
+        """
+        Register and configure a SleekXMPP plugin.
+        Records import and initialization time when profiling startup.
+
+        Arguments:
+            plugin      --- The name of the plugin class.
+
+        Keyworded arguments:
+            pconfig     --- A dictionary of configuration data for the plugin.
+            module      --- Optional refence to the module containing the plugin class.
+
+        """
+        if self.startup_profile is None:
+            return sleekxmpp.ClientXMPP.register_plugin(self, plugin, pconfig, module)
+
+        start = time.time()
+        if not module:
+            try:
+                __import__("sleekxmpp.plugins.{}".format(plugin))
+            except ImportError:
+                # Will be reported by register_plugin
+                pass
+        imported = time.time()
+        sleekxmpp.ClientXMPP.register_plugin(self, plugin, pconfig, module)
+        self.startup_profile.append(("SleekXMPP", plugin, imported - start, time.time() - imported))
+
     def get_our_nick(self, room):
         """
         Get our nick in MUC room.
@@ -275,6 +353,23 @@ class BaseBot(sleekxmpp.ClientXMPP):
             return self.plugin["xep_0045"].ourNicks.get(room)
         return None
 
+    def get_real_jid(self, jid):
+        """
+        Get real JID of the user (if known).
+        For MUC occupant JID returns the real JID when it is available, otherwise returns the given JID.
+
+        Arguments:
+            jid         --- JID object or JID string.
+
+        """
+        if isinstance(jid, str):
+            jid = JID(jid)
+        if "xep_0045" in self.plugin:
+            real_jid = self.plugin["xep_0045"].getJidProperty(jid.bare, jid.resource, "jid")
+            if real_jid is not None and real_jid.full != "":
+                return real_jid
+        return jid
+
     def get_command_level(self, command):
         """
         Get required access level for the command.
@@ -283,6 +378,13 @@ class BaseBot(sleekxmpp.ClientXMPP):
             command     --- Name of the command.
 
         """
+        level = self.command_levels.get(command)
+        if level is None:
+            level = self._resolve_command_level(command)
+        return level
+
+    def _resolve_command_level(self, command):
+        """ Resolve access level of the command from permissions """
         if "command:"+command in self.permissions:
             return self.permissions["command:"+command]
         elif "command" in self.permissions:
@@ -292,6 +394,13 @@ class BaseBot(sleekxmpp.ClientXMPP):
         else:
             return 0
 
+    def get_registry_version(self):
+        """
+        Get current value of registry_version counter.
+
+        """
+        return self.registry_version
+
     def get_user_config(self, jid):
         """
         Get UserConfig corresponding to the given JID.
@@ -335,12 +444,14 @@ class BaseBot(sleekxmpp.ClientXMPP):
 
         """
         log.info(_("Registering bot plugin {!r}.").format(name))
+        stored_config = (module, deepcopy(config))
         try:
             # Prevent re-registration
             if name in self.bot_plugins:
                 raise ValueError(_("Bot plugin {!r} is already registered.").format(name))
 
             # Import the given module that contains the plugin.
+            start = time.time()
             if module is None:
                 module = "plugins.{}".format(name)
             if isinstance(module, str):
@@ -362,10 +473,19 @@ class BaseBot(sleekxmpp.ClientXMPP):
                         raise RuntimeError(_("Bot plugin {!r} needs SleekXMPP plugin {!r}.".format(name, dep)))
 
             # Initialize the plugin
+            imported = time.time()
+            self._registering_plugin = name
+            self.bot_plugin_items[name] = {"commands":[], "help_topics":[]}
             self.bot_plugins[name] = plugin(self, config)
+            self.bot_plugin_configs[name] = stored_config
+            if self.startup_profile is not None:
+                self.startup_profile.append(("bot", name, imported - start, time.time() - imported))
 
         except:
             log.exception(_("Loading of bot plugin {!r} FAILED.").format(name))
+            self._remove_bot_plugin_items(name)
+        finally:
+            self._registering_plugin = None
 
     def deregister_bot_plugins(self):
         """
@@ -390,6 +510,21 @@ class BaseBot(sleekxmpp.ClientXMPP):
                 log.debug(_("Calling the shutdown method of bot plugin {!r}.").format(name))
                 self.bot_plugins[name].shutdown(self)
             del self.bot_plugins[name]
+        if name in self.bot_plugin_configs:
+            del self.bot_plugin_configs[name]
+        self._remove_bot_plugin_items(name)
+
+    def _remove_bot_plugin_items(self, name):
+        """ Remove commands and help topics registered by the bot plugin """
+        items = self.bot_plugin_items.pop(name, None)
+        if items is None:
+            return
+        for command in items["commands"]:
+            self.commands.pop(command, None)
+            self.command_levels.pop(command, None)
+        for topic in items["help_topics"]:
+            self.help_topics.pop(topic, None)
+        self.registry_version += 1
 
     def add_help_topic(self, topic, title=None, body=None):
         """
@@ -404,6 +539,9 @@ class BaseBot(sleekxmpp.ClientXMPP):
 
         """
         self.help_topics[topic] = Help(title, body)
+        if self._registering_plugin is not None:
+            self.bot_plugin_items[self._registering_plugin]["help_topics"].append(topic)
+        self.registry_version += 1
 
     def add_command(self, name, callback, htitle=None, hbody=None, husage=None, level=None):
         """
@@ -437,8 +575,11 @@ class BaseBot(sleekxmpp.ClientXMPP):
                 husage = [husage]
             for part in husage:
                 hbody.append(part)
-        self.add_help_topic(name, htitle, tuple(hbody))
         self.commands[name] = callback
+        self.command_levels[name] = self._resolve_command_level(name)
+        if self._registering_plugin is not None:
+            self.bot_plugin_items[self._registering_plugin]["commands"].append(name)
+        self.add_help_topic(name, htitle, tuple(hbody))
 
     def get_translations(self, lang):
         """
@@ -497,41 +638,83 @@ class KeelsBot(BaseBot):
         load_config             --- Load config file.
         config_sleek_plugins    --- Load configuration and register SleekXMPP plugins.
         config_bot_plugins      --- Load configuration and register bot plugins.
+        report_startup_profile  --- Log import and initialization time of plugins.
 
     """
 
     auto_restart = False
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, profile=False):
         """
         Arguments:
             config_file --- Path to the configuration file.
 
+        Keyworded arguments:
+            profile     --- Report import and initialization time of plugins.
+
         """
+        if profile:
+            self.startup_profile = []
         self.config_file = config_file
         self.load_config()
         auth = dict(self.config.find("/auth").attrib)
         BaseBot.__init__(self, auth)
+        start = time.time()
         self.config_sleek_plugins()
+        sleek_time = time.time() - start
+        start = time.time()
         self.config_bot_plugins()
+        bot_time = time.time() - start
+        if profile:
+            self.report_startup_profile(sleek_time, bot_time)
+            self.startup_profile = None
 
     def reload(self):
         """
         Reloads the config file and makes appropriate runtime changes.
-        Causes all plugins to be reloaded (or unloaded). The XMPP stream, and channels will not be disconnected.
+        Only the plugins with changed configuration are reloaded (or unloaded), the others keep their state.
+        If the storage has changed, all plugins are reloaded. The XMPP stream, and channels will not be disconnected.
+        Returns list of tuples (plugin name, action, seconds spent).
 
         """
-        log.warn(_("Cleaning bot configuration before reload."))
-        self.deregister_bot_plugins()
-        self.commands = {}
-        self.help_topics = {}
-        self.translations = {}
-
         log.info(_("Reloading bot configuration."))
-        self.bot_plugins_stop.clear()
+        store = self.store
+        self.translations = {}
         self.load_config()
         self.sync_rooms()
-        self.config_bot_plugins()
+
+        plugins = self._get_bot_plugins_config()
+        report = []
+        for name in list(self.bot_plugins.keys()):
+            if self.store is store and name in plugins and plugins[name] == self.bot_plugin_configs.get(name):
+                continue
+            start = time.time()
+            self.deregister_bot_plugin(name)
+            report.append([name, __("unloaded"), time.time() - start])
+        if store is not None and self.store is not store:
+            store.shutdown()
+
+        reloaded = dict((item[0], item) for item in report)
+        for name, (module, config) in plugins.items():
+            if name in self.bot_plugins:
+                continue
+            start = time.time()
+            self.register_bot_plugin(name, config, module)
+            if name not in self.bot_plugins:
+                action = __("failed")
+            elif name in reloaded:
+                action = __("reloaded")
+            else:
+                action = __("loaded")
+            if name in reloaded:
+                reloaded[name][1] = action
+                reloaded[name][2] += time.time() - start
+            else:
+                report.append([name, action, time.time() - start])
+
+        for name, action, seconds in report:
+            log.info(_("Bot plugin {!r} {} in {:.3f} seconds.").format(name, action, seconds))
+        return [tuple(item) for item in report]
 
     def restart(self):
         """
@@ -595,23 +778,64 @@ class KeelsBot(BaseBot):
         # Configure persistent storage.
         storage = config.find("/storage")
         if storage is not None:
-            self.store = Storage(storage.get("file"))
+            synchronous = storage.get("synchronous", "NORMAL").upper()
+            if self.store is None or self.store.filename != storage.get("file") or self.store.synchronous != synchronous:
+                self.store = Storage(storage.get("file"), synchronous)
+            self.store.delay = float(storage.get("delay", 0.5))
+            self.store.batch = max(1, int(storage.get("batch", 100)))
+            self.store.slow_query = float(storage.get("slow", 0.5))
         else:
             self.store = None
             log.warn(_("No storage element found in config file - proceeding with no persistent storage, plugin behaviour may be undefined."))
 
-        # Configure permissions
+        # Configure maintenance of the storage.
+        if self.maintenance is not None:
+            self.maintenance.stop()
+            self.maintenance = None
+        maintenance = config.find("/maintenance")
+        if maintenance is not None and self.store is not None:
+            retention = []
+            for policy in maintenance.findall("retention"):
+                retention.append(RetentionPolicy(policy.get("table"), policy.get("column", "timestamp"), float(policy.get("days"))))
+            self.maintenance = Maintenance(self.store,
+                                           interval=float(maintenance.get("interval", 600)),
+                                           quiet=float(maintenance.get("quiet", 60)),
+                                           backup_file=maintenance.get("backup"),
+                                           backup_interval=float(maintenance.get("backup_interval", 86400)),
+                                           retention=retention,
+                                           batch=int(maintenance.get("batch", 1000)),
+                                           vacuum_pages=int(maintenance.get("vacuum_pages", 1000)),
+                                           analyze_interval=float(maintenance.get("analyze_interval", 86400)))
+            self.maintenance.start()
+
+        # Configure permissions and command execution limits
         self.permissions = {}
+        limits = {}
         default_level = 0
+        default_limits = CommandLimits(0, 0)
+        concurrency = 0
+        rate = 0
+        burst = 1
         default_permission = config.find("/permissions")
         if default_permission is not None:
             default_level = int(default_permission.get("level", default_level))
+            default_limits = CommandLimits(float(default_permission.get("timeout", 0)), 0)
+            concurrency = int(default_permission.get("concurrency", concurrency))
+            rate = float(default_permission.get("rate", rate))
+            burst = int(default_permission.get("burst", burst))
             for element in default_permission:
                 item = element.tag
                 if element.text is not None:
                     item += ":" + element.text
                 self.permissions[item] = int(element.get("level", default_level))
+                if element.tag == "command" and element.text is not None:
+                    limits[element.text] = CommandLimits(float(element.get("timeout", default_limits.timeout)), int(element.get("concurrency", 0)))
         self.permissions[None] = default_level
+        self.command_levels = dict((name, self._resolve_command_level(name)) for name in self.commands)
+        self.registry_version += 1
+        if self.executor is None:
+            self.executor = CommandExecutor()
+        self.executor.configure(concurrency, rate, burst, default_limits, limits)
 
         # Configure users
         self.users = []
@@ -659,14 +883,33 @@ class KeelsBot(BaseBot):
 
         """
         log.debug(_("Configuring bot plugins."))
+        for name, (module, config) in self._get_bot_plugins_config().items():
+            log.debug(_("Adding bot plugin {!r}.").format(name))
+            self.register_bot_plugin(name, config, module)
+
+    def report_startup_profile(self, sleek_time, bot_time):
+        """
+        Log import and initialization time of plugins.
+
+        Arguments:
+            sleek_time  --- Total time spent configuring SleekXMPP plugins.
+            bot_time    --- Total time spent configuring bot plugins.
+
+        """
+        log.warn(_("Startup profile: core modules imported in {:.3f} s, SleekXMPP plugins configured in {:.3f} s, bot plugins in {:.3f} s.").format(_core_import_time, sleek_time, bot_time))
+        for kind, name, import_time, init_time in sorted(self.startup_profile, key=lambda item: item[2]+item[3], reverse=True):
+            log.warn(_("Startup profile: {} plugin {!r} imported in {:.3f} s, initialized in {:.3f} s.").format(kind, name, import_time, init_time))
+
+    def _get_bot_plugins_config(self):
+        """ Return OrderedDict of bot plugin names and tuples (module, config) """
+        plugins = OrderedDict()
         for plugin in self.config.findall("/keels/plugin"):
             name = plugin.get("name")
-            if "name" is None:
+            if name is None:
                 log.error(_("Ignoring unnamed bot plugin."))
                 continue
-            log.debug(_("Adding bot plugin {!r}.").format(name))
-            config = self._parse_plugin_config(list(plugin))
-            self.register_bot_plugin(name, config, plugin.get("module"))
+            plugins[name] = (plugin.get("module"), self._parse_plugin_config(list(plugin)))
+        return plugins
 
     def _parse_plugin_config(self, elements):
         """ Parse plugin configuration """
@@ -699,13 +942,14 @@ if __name__ == "__main__":
     optp.add_option("-d", "--debug", help=_("set logging to DEBUG"), dest="loglevel", action="store_const", const=logging.DEBUG)
     optp.add_option("-D", "--Debug", help=_("set logging to ALL"), dest="loglevel", action="store_const", const=0)
     optp.add_option("-c", "--config", help=_("path to config file"), dest="configfile", default="config.xml")
+    optp.add_option("-p", "--profile", help=_("report import and initialization time of plugins"), dest="profile", action="store_true", default=False)
 
     opts,args = optp.parse_args()
     rootlog.setLevel(opts.loglevel)
     colterm.use_color(opts.color)
 
     # Check requirements
-    minVersion = "3.1"
+    minVersion = "3.2"
     if python_version() < minVersion:
         log.critical(_("You need at least Python {} to run this script.")).format(minVersion)
 
@@ -715,6 +959,6 @@ if __name__ == "__main__":
 
     auto_restart = True
     while auto_restart:
-        bot = KeelsBot(config_file)
+        bot = KeelsBot(config_file, opts.profile)
         bot.run()
         auto_restart = bot.auto_restart
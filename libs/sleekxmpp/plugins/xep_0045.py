@@ -297,20 +297,59 @@ class xep_0045(base.base_plugin):
             return False
         return True
 
+    def setAffiliations(self, room, affiliations, reason=None, callback=None):
+        """ Change room affiliations of many users in a single IQ.
+
+            affiliations -- Iterable of (jid, affiliation) pairs.
+            callback     -- If given, the IQ is sent asynchronously and callback
+                            is called with the result (or error) stanza.
+        """
+        items = []
+        for jid, affiliation in affiliations:
+            if affiliation not in ('outcast', 'member', 'admin', 'owner', 'none'):
+                raise TypeError
+            items.append({"affiliation": affiliation, "jid": str(jid)})
+        return self.adminQueryItems(room, items, reason, callback)
+
+    def setRoles(self, room, roles, reason=None, callback=None):
+        """ Change room roles of many users in a single IQ.
+
+            roles    -- Iterable of (nick, role) pairs.
+            callback -- If given, the IQ is sent asynchronously and callback
+                        is called with the result (or error) stanza.
+        """
+        items = []
+        for nick, role in roles:
+            if role not in ('moderator', 'none', 'participant', 'visitor'):
+                raise TypeError
+            items.append({"role": role, "nick": nick})
+        return self.adminQueryItems(room, items, reason, callback)
+
     def adminQuery(self, room, item_attribs, reason=None):
         """ Admin query. """
-        item = ET.Element('item', item_attribs)
-        if reason is not None:
-            xreason = ET.Element("reason")
-            xreason.text = reason
-            item.append(xreason)
+        if not self.adminQueryItems(room, [item_attribs], reason):
+            raise ValueError
+
+    def adminQueryItems(self, room, items, reason=None, callback=None):
+        """ Admin query with many items in a single IQ.
+
+            Returns True on success, or the callback handler name if
+            callback is given (the IQ is sent asynchronously then).
+        """
         query = ET.Element('{http://jabber.org/protocol/muc#admin}query')
-        query.append(item)
+        for item_attribs in items:
+            item = ET.Element('item', item_attribs)
+            if reason is not None:
+                xreason = ET.Element("reason")
+                xreason.text = reason
+                item.append(xreason)
+            query.append(item)
         iq = self.xmpp.makeIqSet(query)
         iq['to'] = room
+        if callback is not None:
+            return iq.send(callback=callback)
         result = iq.send()
-        if result is False or result['type'] != 'result':
-            raise ValueError
+        return result is not False and result['type'] == 'result'
 
     def invite(self, room, jid, reason='', mfrom=''):
         """ Invite a jid to a room."""
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Module for background maintenance of the persistent sqlite3 storage.
+
+Classes:
+    RetentionPolicy --- Retention policy of a table.
+    Maintenance     --- Background maintenance service of the Storage.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+__version__ = "0.5.0"
+
+from collections import namedtuple
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RetentionPolicy = namedtuple("RetentionPolicy", "table column days")
+
+
+class Maintenance:
+    """
+    Background maintenance service of the Storage.
+    Periodically makes online backups of the database, deletes rows older than the retention period
+    and (while the storage is quiet) runs incremental vacuum and ANALYZE.
+
+    Attributes:
+        store               --- Storage instance.
+        interval            --- Number of seconds between maintenance rounds.
+        quiet               --- Number of seconds without writes after which the storage is considered quiet.
+        backup_file         --- Path to the backup file (None disables backups).
+        backup_interval     --- Number of seconds between backups.
+        retention           --- List of RetentionPolicy.
+        batch               --- Maximum number of rows deleted in a single transaction.
+        vacuum_pages        --- Maximum number of free pages released in a single round.
+        analyze_interval    --- Number of seconds between ANALYZE runs.
+
+    Methods:
+        start               --- Start the maintenance thread.
+        stop                --- Stop the maintenance thread.
+        run_once            --- Perform a single maintenance round.
+        backup              --- Make online backup of the database.
+        apply_retention     --- Delete rows older than the retention period.
+        vacuum              --- Release free pages of the database file.
+        analyze             --- Update query planner statistics.
+
+    """
+
+    _identifier_re = re.compile(r"^\w+$")
+
+    def __init__(self, store, interval=600, quiet=60, backup_file=None, backup_interval=86400, retention=(), batch=1000, vacuum_pages=1000, analyze_interval=86400):
+        """
+        Arguments:
+            store               --- Storage instance.
+
+        Keyworded arguments:
+            interval            --- Number of seconds between maintenance rounds.
+            quiet               --- Number of seconds without writes after which the storage is considered quiet.
+            backup_file         --- Path to the backup file (None disables backups).
+            backup_interval     --- Number of seconds between backups.
+            retention           --- Sequence of RetentionPolicy.
+            batch               --- Maximum number of rows deleted in a single transaction.
+            vacuum_pages        --- Maximum number of free pages released in a single round.
+            analyze_interval    --- Number of seconds between ANALYZE runs.
+
+        """
+        self.store = store
+        self.interval = interval
+        self.quiet = quiet
+        self.backup_file = backup_file
+        self.backup_interval = backup_interval
+        self.retention = []
+        for policy in retention:
+            if self._identifier_re.match(policy.table) is None or self._identifier_re.match(policy.column) is None:
+                log.error(_("Invalid retention policy {!r}, ignoring it.").format(policy))
+                continue
+            self.retention.append(policy)
+        self.batch = max(1, batch)
+        self.vacuum_pages = vacuum_pages
+        self.analyze_interval = analyze_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_backup = 0
+        self._last_analyze = 0
+        if backup_file is not None and os.path.exists(backup_file):
+            self._last_backup = os.path.getmtime(backup_file)
+
+    def start(self):
+        """
+        Start the maintenance thread.
+
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="storage_maintenance")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the maintenance thread, wait for the running step to finish.
+
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        """
+        Perform a single maintenance round.
+        Backup runs regardless of the storage activity, the rest only if the storage is quiet.
+
+        """
+        now = time.time()
+        if self.backup_file is not None and now - self._last_backup >= self.backup_interval:
+            self.backup()
+        if self._stop.is_set() or self.store.idle_time() < self.quiet:
+            return
+        self.apply_retention()
+        if self._stop.is_set() or self.store.idle_time() < self.quiet:
+            return
+        self.vacuum()
+        if now - self._last_analyze >= self.analyze_interval and not self._stop.is_set():
+            self.analyze()
+
+    def backup(self, filename=None, pages=1000):
+        """
+        Make online backup of the database.
+        The backup is written to a temporary file first and then atomically replaces the old one.
+
+        Keyworded arguments:
+            filename            --- Path to the backup file (backup_file by default).
+            pages               --- Number of pages copied in a single step, other connections may write between steps.
+
+        """
+        filename = filename or self.backup_file
+        if not hasattr(sqlite3.Connection, "backup"):
+            log.error(_("Online backup of the database requires Python 3.7 or newer."))
+            return False
+        temp = filename + ".tmp"
+        start = time.time()
+        try:
+            target = sqlite3.connect(temp)
+            try:
+                with self.store.connection() as db:
+                    db.backup(target, pages=pages, sleep=0.01)
+            finally:
+                target.close()
+            os.replace(temp, filename)
+        except (sqlite3.Error, OSError):
+            log.exception(_("Backup of the database to {!r} FAILED.").format(filename))
+            return False
+        self._last_backup = time.time()
+        log.info(_("Database backed up to {!r} in {:.3f} seconds.").format(filename, time.time() - start))
+        return True
+
+    def apply_retention(self):
+        """
+        Delete rows older than the retention period in batches, each batch in its own transaction.
+        Stops early when the storage stops being quiet.
+
+        """
+        for policy in self.retention:
+            limit = int(time.time() - policy.days * 86400)
+            query = "DELETE FROM [{0}] WHERE rowid IN (SELECT rowid FROM [{0}] WHERE [{1}]<? LIMIT ?)".format(policy.table, policy.column)
+            deleted = 0
+            while not self._stop.is_set():
+                try:
+                    with self.store.connection() as db:
+                        count = db.execute(query, (limit, self.batch)).rowcount
+                except sqlite3.Error:
+                    log.exception(_("Retention of table {!r} FAILED.").format(policy.table))
+                    break
+                deleted += count
+                if count < self.batch or self.store.idle_time() < self.quiet:
+                    break
+            if deleted > 0:
+                log.info(_("Deleted {} old rows from table {!r}.").format(deleted, policy.table))
+
+    def vacuum(self):
+        """
+        Release free pages of the database file.
+        The first run switches the database to incremental auto_vacuum mode, which requires a full VACUUM.
+
+        """
+        try:
+            with self.store.connection() as db:
+                mode = db.execute("PRAGMA auto_vacuum").fetchone()[0]
+                if mode != 2:
+                    log.info(_("Switching database to incremental auto_vacuum mode."))
+                    db.commit()
+                    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    db.execute("VACUUM")
+                else:
+                    db.execute("PRAGMA incremental_vacuum({})".format(int(self.vacuum_pages))).fetchall()
+        except sqlite3.Error:
+            log.exception(_("Vacuum of the database FAILED."))
+
+    def analyze(self):
+        """
+        Update query planner statistics.
+
+        """
+        try:
+            with self.store.connection() as db:
+                db.execute("ANALYZE")
+        except sqlite3.Error:
+            log.exception(_("Analyze of the database FAILED."))
+        self._last_analyze = time.time()
+
+    def _loop(self):
+        """ Run maintenance rounds until stopped """
+        log.debug(_("Entering storage maintenance loop."))
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except:
+                log.exception(_("Storage maintenance FAILED."))
+        log.debug(_("Exiting storage maintenance loop."))
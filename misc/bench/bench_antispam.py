@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of antispam message checks in a room with many active users.
+
+Messages are fed to check_spam with a simulated clock (one message every --step seconds),
+the scheduled cleanup of idle users is timed separately. Compare with another revision
+by pointing --root to its checkout.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+import logging
+from optparse import OptionParser
+import os.path
+import random
+import sys
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+ROOM = "room@conf.example.com"
+
+
+class Clock:
+    """ Simulated time module of the plugin """
+
+    def __init__(self):
+        self.now = 1300000000.0
+
+    def time(self):
+        return self.now
+
+
+class MUC:
+    """ xep_0045 plugin of a bot moderating a room of ordinary participants """
+
+    ourNicks = {ROOM:"KeelsBot"}
+
+    def __init__(self):
+        self.actions = 0
+
+    def getJoinedRooms(self):
+        return [ROOM]
+
+    def getJidProperty(self, room, nick, name):
+        if name == "jid":
+            return "{}@example.com/resource".format(nick)
+        if nick == "KeelsBot":
+            return {"role":"moderator", "affiliation":"owner"}[name]
+        return {"role":"participant", "affiliation":"none"}[name]
+
+    def _action(self, *args, **kwargs):
+        self.actions += 1
+
+    setRole = setAffiliation = setRoles = setAffiliations = _action
+
+
+class Message(dict):
+    def reply(self, body):
+        return self
+
+    def send(self):
+        pass
+
+
+class UserConfig:
+    lang = "en"
+
+
+class Bot:
+    def schedule(self, *args, **kwargs):
+        pass
+
+    def send_message(self, *args, **kwargs):
+        pass
+
+    def get_user_config(self, jid):
+        return UserConfig
+
+    def gettext(self, text, lang):
+        return text
+
+    def ngettext(self, singular, plural, count, lang):
+        return singular if count == 1 else plural
+
+    def add_event_handler(self, *args, **kwargs):
+        pass
+
+    def del_event_handler(self, *args, **kwargs):
+        pass
+
+
+def main():
+    optp = OptionParser(usage="%prog [options]")
+    optp.add_option("-r", "--root", help="path to keelsbot checkout to benchmark", dest="root", default=ROOT)
+    optp.add_option("-u", "--users", help="number of active users", dest="users", type="int", default=1000)
+    optp.add_option("-n", "--count", help="number of messages", dest="count", type="int", default=100000)
+    optp.add_option("-s", "--step", help="number of seconds between messages", dest="step", type="float", default=0.03)
+    opts, args = optp.parse_args()
+
+    sys.path.insert(0, opts.root)
+    gettext.install("keelsbot")
+    logging.basicConfig(level=logging.ERROR)
+    from plugins import antispam as module
+
+    clock = module.time = Clock()
+    module.antispam.xep_0045 = muc = MUC()
+    config = {"muc":[{"room":ROOM, "limit":[{"type":"message", "interval":"10", "limit":"5", "expiration":"300"},
+                                            {"type":"character", "interval":"60", "limit":"5000", "expiration":"60"}]}]}
+    plugin = module.antispam(Bot(), config)
+    plugin.running = True
+
+    rnd = random.Random(1)
+    messages = []
+    for i in range(opts.count):
+        nick = "nick{}".format(rnd.randrange(opts.users))
+        messages.append(Message(mucroom=ROOM, mucnick=nick, body="hello world " * rnd.randint(1, 5), **{"from":"{}/{}".format(ROOM, nick)}))
+    start = time.time()
+    for msg in messages:
+        clock.now += opts.step
+        plugin.check_spam(msg)
+    elapsed = time.time() - start
+    print("check_spam: {:.1f} us/message, {} actions".format(elapsed / opts.count * 1e6, muc.actions))
+
+    if hasattr(plugin, "cleanup"):
+        clock.now += 30
+        start = time.time()
+        plugin.cleanup()
+        print("cleanup: {:.1f} ms".format((time.time() - start) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
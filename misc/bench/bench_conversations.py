@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of chatbot query matching over the shipped misc/conversations dictionaries.
+
+A fixed corpus of short chat lines is matched in public room, direct and private scopes.
+Memoization of repeated messages is disabled by default to measure the matcher itself.
+Compare with another revision by pointing --root to its checkout.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+import logging
+from optparse import OptionParser
+import os.path
+import random
+import sys
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+WORDS = ("ahoj", "jo", "nj", ":)", "hele", "co", "děláš", "pivo", "dobrou", "noc", "jak", "se", "máš", "díky", "ty", "vole",
+         "proč", "to", "nejde?", "s", "tím", "je?", "kdo", "jsi", "bot", "zapomeň", "na", "aaaaaaa", "hello", "what")
+FLAGS = (["chat", "global", "public"], ["chat", "direct", "public"], ["chat", "direct", "private"])
+
+
+def main():
+    optp = OptionParser(usage="%prog [options]")
+    optp.add_option("-r", "--root", help="path to keelsbot checkout to benchmark", dest="root", default=ROOT)
+    optp.add_option("-n", "--count", help="number of distinct messages", dest="count", type="int", default=3000)
+    optp.add_option("-R", "--repeat", help="number of passes over the messages", dest="repeat", type="int", default=5)
+    optp.add_option("-m", "--memo", help="number of memoized messages (if supported)", dest="memo", type="int", default=0)
+    opts, args = optp.parse_args()
+
+    sys.path.insert(0, opts.root)
+    gettext.install("keelsbot")
+    logging.basicConfig(level=logging.ERROR)
+    from plugins.chatbot import Conversations
+
+    files = [os.path.join(opts.root, "misc", "conversations", "*.xml")]
+    start = time.time()
+    if "memo_size" in Conversations.__init__.__code__.co_varnames:
+        conversations = Conversations(files, memo_size=opts.memo)
+    else:
+        conversations = Conversations(files)
+    print("loaded {} queries in {:.3f} s".format(len(conversations.queries), time.time() - start))
+
+    rnd = random.Random(1)
+    messages = [" ".join(rnd.choice(WORDS) for i in range(rnd.randint(1, 8))) for j in range(opts.count)]
+    replies = 0
+    start = time.time()
+    for rep in range(opts.repeat):
+        for i, message in enumerate(messages):
+            if conversations.get_response([], [], message, FLAGS[i % len(FLAGS)])[0] is not None:
+                replies += 1
+    elapsed = time.time() - start
+    print("get_response: {:.1f} us/message, {} replies".format(elapsed / (opts.count * opts.repeat) * 1e6, replies))
+
+
+if __name__ == "__main__":
+    main()
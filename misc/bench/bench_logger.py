@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the chatbot conversation logger.
+
+Logs messages from many rooms (every third one with a response) and reports the time spent
+by the caller and the total throughput including writing out all records.
+Compare with another revision by pointing --root to its checkout.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+import glob
+import logging
+from optparse import OptionParser
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+
+def main():
+    optp = OptionParser(usage="%prog [options]")
+    optp.add_option("-r", "--root", help="path to keelsbot checkout to benchmark", dest="root", default=ROOT)
+    optp.add_option("-n", "--count", help="number of messages", dest="count", type="int", default=20000)
+    optp.add_option("-R", "--rooms", help="number of rooms", dest="rooms", type="int", default=20)
+    opts, args = optp.parse_args()
+
+    sys.path.insert(0, opts.root)
+    gettext.install("keelsbot")
+    logging.basicConfig(level=logging.ERROR)
+    from plugins.chatbot import Logger
+
+    messages = []
+    for i in range(opts.count):
+        messages.append({"type":"groupchat", "mucroom":"room{}@conf.example.com".format(i % opts.rooms),
+                         "mucnick":"nick{}".format(i % 50), "body":"hello world {}".format(i)})
+
+    directory = tempfile.mkdtemp()
+    try:
+        if "backlog" in Logger.__init__.__code__.co_varnames:
+            logger = Logger(directory, backlog=opts.count)
+        else:
+            logger = Logger(directory)
+        start = time.time()
+        for i, msg in enumerate(messages):
+            logger.log(msg, None if i % 3 else "response")
+        logged = time.time()
+        if hasattr(logger, "shutdown"):
+            logger.shutdown()
+        elapsed = time.time() - start
+        lines = 0
+        for filename in glob.glob(os.path.join(directory, "*")):
+            with open(filename) as fp:
+                lines += sum(1 for line in fp)
+        print("caller: {:.1f} us/record, total: {:.0f} records/s, {} lines written".format((logged - start) / opts.count * 1e6, opts.count / elapsed, lines))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
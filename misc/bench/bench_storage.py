@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of Storage writes: seen-style INSERT OR REPLACE statements per second.
+
+Compare with another revision by pointing --root to its checkout, e.g.
+    git worktree add /tmp/keelsbot-old <revision>
+    python3 misc/bench/bench_storage.py --root /tmp/keelsbot-old
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+from optparse import OptionParser
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+
+def insert(store, method, count):
+    """ Insert count seen records by the method of store, return number of inserts per second """
+    start = time.time()
+    for i in range(count):
+        with store.lock:
+            method("INSERT OR REPLACE INTO seen (room, nick, event, timestamp, text) VALUES(?,?,?,?,?)",
+                   ("room@conf.example.com", "nick{}".format(i % 300), i % 4, int(time.time()), "text"))
+    if hasattr(store, "flush"):
+        store.flush()
+    return count / (time.time() - start)
+
+
+def main():
+    optp = OptionParser(usage="%prog [options]")
+    optp.add_option("-r", "--root", help="path to keelsbot checkout to benchmark", dest="root", default=ROOT)
+    optp.add_option("-n", "--count", help="number of inserts", dest="count", type="int", default=2000)
+    opts, args = optp.parse_args()
+
+    sys.path.insert(0, opts.root)
+    gettext.install("keelsbot")
+    from storage import Storage
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = Storage(os.path.join(directory, "keelsbot.sqlite"))
+        store.query("CREATE TABLE seen (room VARCHAR(256), nick VARCHAR(256), event INTEGER, timestamp INTEGER, text VARCHAR(256), PRIMARY KEY (room, nick, event))")
+        print("query: {:8.0f} inserts/s".format(insert(store, store.query, opts.count)))
+        if hasattr(store, "write"):
+            print("write: {:8.0f} inserts/s".format(insert(store, store.write, opts.count)))
+        if hasattr(store, "shutdown"):
+            store.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stress benchmark of Storage: several threads issuing mixed plugin workloads
+(seen reads and writes, vocabulary weight writes, feed inserts) for a few seconds.
+
+With --global-lock every statement is serialized on Storage.lock, as the plugins used to do,
+otherwise each plugin uses its own lock. Compare with another revision by pointing --root to its checkout.
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+from optparse import OptionParser
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+NICKS = 5000
+
+
+def worker(store, kind, lock, deadline, counts):
+    """ Run the workload until the deadline, record the number of operations """
+    write = getattr(store, "write", store.query)
+    count = 0
+    while time.time() < deadline:
+        with lock:
+            if kind == "seen_read":
+                store.query("SELECT event, timestamp, text FROM seen WHERE room=? AND nick=?", ("room", "nick{}".format(random.randrange(NICKS))))
+            elif kind == "seen_write":
+                write("INSERT OR REPLACE INTO seen (room, nick, event, timestamp, text) VALUES(?,?,?,?,?)", ("room", "nick{}".format(random.randrange(NICKS)), 0, int(time.time()), "text"))
+            elif kind == "vocabulary_write":
+                store.query("INSERT OR REPLACE INTO vocabulary_weights (jid, vocabulary_id, left) VALUES(?,?,?)", ("user@example.com", random.randrange(100), 3))
+            elif kind == "feed_write":
+                write("INSERT OR REPLACE INTO feeds (feed, item, timestamp) VALUES(?,?,?)", ("http://example.com/feed", "item{}".format(random.randrange(10 ** 6)), int(time.time())))
+        count += 1
+    counts.append((kind, count))
+
+
+def main():
+    optp = OptionParser(usage="%prog [options]")
+    optp.add_option("-r", "--root", help="path to keelsbot checkout to benchmark", dest="root", default=ROOT)
+    optp.add_option("-t", "--duration", help="number of seconds to run", dest="duration", type="float", default=3.0)
+    optp.add_option("-g", "--global-lock", help="serialize all statements on Storage.lock", dest="global_lock", action="store_true", default=False)
+    opts, args = optp.parse_args()
+
+    sys.path.insert(0, opts.root)
+    gettext.install("keelsbot")
+    from storage import Storage
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = Storage(os.path.join(directory, "keelsbot.sqlite"))
+        store.query("CREATE TABLE seen (room VARCHAR(256), nick VARCHAR(256), event INTEGER, timestamp INTEGER, text VARCHAR(256), PRIMARY KEY (room, nick, event))")
+        store.query("CREATE TABLE vocabulary_weights (jid VARCHAR(256), vocabulary_id INTEGER, left INTEGER, right INTEGER, PRIMARY KEY (jid, vocabulary_id))")
+        store.query("CREATE TABLE feeds (feed VARCHAR(256), item VARCHAR(256), timestamp INTEGER, PRIMARY KEY (feed, item))")
+        for nick in range(NICKS):
+            store.query("INSERT INTO seen (room, nick, event, timestamp, text) VALUES(?,?,?,?,?)", ("room", "nick{}".format(nick), 0, nick, "text"))
+
+        locks = {}
+        for plugin in ("seen", "vocabulary", "feedreader"):
+            if opts.global_lock or not hasattr(store, "get_lock"):
+                locks[plugin] = Storage.lock
+            else:
+                locks[plugin] = store.get_lock(plugin)
+        workloads = [("seen_read", "seen")] * 4 + [("seen_write", "seen")] * 2 + [("vocabulary_write", "vocabulary"), ("feed_write", "feedreader")]
+        deadline = time.time() + opts.duration
+        counts = []
+        threads = [threading.Thread(target=worker, args=(store, kind, locks[plugin], deadline, counts)) for kind, plugin in workloads]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if hasattr(store, "shutdown"):
+            store.shutdown()
+
+        totals = {}
+        for kind, count in counts:
+            totals[kind] = totals.get(kind, 0) + count
+        print(" ".join("{}={:.0f}/s".format(kind, totals[kind] / opts.duration) for kind in sorted(totals)))
+        # seen and feed writes share the write-behind queue, their split depends on the lock contention
+        print("write-behind total={:.0f}/s".format((totals["seen_write"] + totals["feed_write"]) / opts.duration))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,8 @@ class admin:
         self.bot_reload = bot.reload
         self.bot_restart = bot.restart
         self.bot_die = bot.die
+        self.store = bot.store
+        self.get_sleek_plugin = bot.plugin.get
         self.gettext = bot.gettext
         self.ngettext = bot.ngettext
 
@@ -33,10 +35,16 @@ class admin:
         bot.add_command("die", self.die, __("Die"), __("Kill the bot."))
         bot.add_command("loglevel", self.loglevel, __("Log level"), __("Set the level of logging."), "<0-50|{}>".format("|".join(sorted(self.loglevels.keys()))))
         bot.add_command("level", self.level, __("User level"), __("Display user's access level."))
+        bot.add_command("sqlstats", self.sqlstats, __("SQL statistics"), __("Display the most expensive SQL statements, or forget the statistics."), "[count|reset]")
+        bot.add_command("kick", self.kick, __("Kick"), __("Kick users from the room, one nick per line."), "[<room>] <nick>[\n<nick>...]")
+        bot.add_command("ban", self.ban, __("Ban"), __("Ban JIDs from the room."), "[<room>] <jid> [<jid>...]")
 
     def reload(self, command, args, msg, uc):
-        self.bot_reload()
-        return self.gettext("Reloaded, boss.", uc.lang)
+        report = self.bot_reload()
+        lines = [self.gettext("Reloaded, boss.", uc.lang)]
+        for name, action, seconds in report:
+            lines.append("{}: {} ({:.3f} s)".format(name, self.gettext(action, uc.lang), seconds))
+        return "\n".join(lines)
 
     def restart(self, command, args, msg, uc):
         self.bot_restart()
@@ -62,3 +70,54 @@ class admin:
 
     def level(self, command, args, msg, uc):
         return self.gettext("You're on level {}.", uc.lang).format(uc.level)
+
+    def sqlstats(self, command, args, msg, uc):
+        if self.store is None:
+            return self.gettext("There's no persistent storage.", uc.lang)
+        args = args.strip().lower()
+        if args == "reset":
+            self.store.reset_stats()
+            return self.gettext("SQL statistics were reset.", uc.lang)
+        limit = 10
+        if args.isdigit():
+            limit = int(args)
+        lines = []
+        for item in self.store.get_stats(limit):
+            lines.append("{:.3f} s / {}× (max {:.3f} s, wait {:.3f} s, {} rows) {}: {}".format(item.total, item.count, item.max, item.wait, item.rows, item.source, item.query))
+        if len(lines) == 0:
+            return self.gettext("No SQL statements were executed yet.", uc.lang)
+        return "\n".join(lines)
+
+    def kick(self, command, args, msg, uc):
+        xep_0045 = self.get_sleek_plugin("xep_0045")
+        if xep_0045 is None:
+            return self.gettext("Multi-user chat is not enabled.", uc.lang)
+        room, nicks = self._parse_targets(xep_0045, args, msg)
+        nicks = [nick.strip() for nick in nicks.split("\n") if nick.strip() != ""]
+        if room is None or len(nicks) == 0:
+            return self.gettext("You must specify the room and nicks.", uc.lang)
+        if xep_0045.setRoles(room, [(nick, "none") for nick in nicks]):
+            return self.ngettext("Kicked {} user.", "Kicked {} users.", len(nicks), uc.lang).format(len(nicks))
+        return self.gettext("The room refused the request.", uc.lang)
+
+    def ban(self, command, args, msg, uc):
+        xep_0045 = self.get_sleek_plugin("xep_0045")
+        if xep_0045 is None:
+            return self.gettext("Multi-user chat is not enabled.", uc.lang)
+        room, jids = self._parse_targets(xep_0045, args, msg)
+        jids = jids.split()
+        if room is None or len(jids) == 0:
+            return self.gettext("You must specify the room and JIDs.", uc.lang)
+        if xep_0045.setAffiliations(room, [(jid, "outcast") for jid in jids]):
+            return self.ngettext("Banned {} JID.", "Banned {} JIDs.", len(jids), uc.lang).format(len(jids))
+        return self.gettext("The room refused the request.", uc.lang)
+
+    def _parse_targets(self, xep_0045, args, msg):
+        """ Split the room JID from the rest of args, default to the room the command came from """
+        args = args.strip()
+        first = args.split(None, 1)
+        if len(first) > 0 and "@" in first[0] and first[0] in xep_0045.getJoinedRooms():
+            return first[0], (first[1] if len(first) > 1 else "")
+        if msg["type"] == "groupchat":
+            return msg["mucroom"], args
+        return None, args
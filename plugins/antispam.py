@@ -11,22 +11,392 @@ __license__ = "GPL 3.0"
 __version__ = "0.5.0"
 
 
+from collections import deque, OrderedDict
 import logging
+import re
+import threading
 import time
+import unicodedata
 
 log = logging.getLogger(__name__)
 __ = lambda x: x # Fake gettext function
 
 
+class WindowCounter:
+    """
+    Sliding window counter split into fixed-width time buckets.
+    Adding is O(1) amortized, the count may include at most one bucket older than the interval.
+
+    Attributes:
+        interval    --- Length of the window in seconds.
+        width       --- Width of a bucket in seconds.
+        total       --- Sum of the amounts in the window.
+
+    Methods:
+        add         --- Add amount to the counter and return the current total.
+        expire      --- Drop the buckets older than the window.
+
+    """
+
+    __slots__ = ("interval", "width", "buckets", "total")
+    resolution = 60
+
+    def __init__(self, interval):
+        """
+        Arguments:
+            interval    --- Length of the window in seconds.
+
+        """
+        self.interval = interval
+        self.width = max(1, interval / self.resolution)
+        self.buckets = deque()
+        self.total = 0
+
+    def expire(self, now):
+        """
+        Drop the buckets older than the window, return the current total.
+
+        Arguments:
+            now         --- Current timestamp.
+
+        """
+        age = now - self.interval
+        buckets = self.buckets
+        while len(buckets) > 0 and buckets[0][0] + self.width <= age:
+            self.total -= buckets.popleft()[1]
+        return self.total
+
+    def add(self, now, amount=1):
+        """
+        Add amount to the counter and return the current total.
+
+        Arguments:
+            now         --- Current timestamp.
+
+        Keyworded arguments:
+            amount      --- Amount to add.
+
+        """
+        self.expire(now)
+        start = now - now % self.width
+        if len(self.buckets) > 0 and self.buckets[-1][0] == start:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([start, amount])
+        self.total += amount
+        return self.total
+
+
+class FingerprintWindow:
+    """
+    Bounded window of recent message fingerprints in a room.
+    Messages with the same normalized text, or with simhash differing in at most distance bits, form a cluster.
+    Near-identical simhashes are found through banding (8 bands of 8 bits): pairs within distance 7 always share a band,
+    pairs within distance 10 with about 97% probability, random pairs are within distance 10 with probability 1e-8.
+
+    Attributes:
+        interval    --- Number of seconds a message stays in its cluster.
+        size        --- Maximum number of clusters.
+        min_length  --- Shorter normalized texts are ignored.
+        distance    --- Maximum Hamming distance of simhashes in a cluster.
+        clusters    --- OrderedDict cluster id -> Cluster, the least recently updated first.
+
+    Methods:
+        add         --- Add the message to its cluster and return the cluster.
+        expire      --- Drop the clusters without messages in the interval.
+
+    """
+
+    mask = (1 << 64) - 1
+    # Spreads bits of a byte into 8 bit lanes, simhash sums 8 bytes of the feature hashes in parallel
+    spread = tuple(sum(((value >> bit) & 1) << (8 * bit) for bit in range(8)) for value in range(256))
+    _word_re = re.compile(r"[^\W_]+")
+    _digit_re = re.compile(r"\d")
+    # feature -> spread hash, chat words repeat a lot
+    _features = {}
+    _max_features = 10000
+
+    class Cluster:
+        """ Messages with (nearly) identical text """
+        __slots__ = ("id", "exact", "simhash", "messages", "punished")
+
+        def __init__(self, id, exact, simhash):
+            self.id = id
+            self.exact = exact
+            self.simhash = simhash
+            # deque of (timestamp, jid, nick)
+            self.messages = deque()
+            # set of punished JIDs
+            self.punished = set()
+
+        def senders(self, repeat=1):
+            """ Return dictionary jid -> nick of the senders with at least repeat messages """
+            counts = {}
+            nicks = {}
+            for timestamp, jid, nick in self.messages:
+                counts[jid] = counts.get(jid, 0) + 1
+                nicks[jid] = nick
+            return dict((jid, nick) for jid, nick in nicks.items() if counts[jid] >= repeat)
+
+    def __init__(self, interval, size=500, min_length=20, distance=10):
+        """
+        Arguments:
+            interval    --- Number of seconds a message stays in its cluster.
+
+        Keyworded arguments:
+            size        --- Maximum number of clusters.
+            min_length  --- Shorter normalized texts are ignored.
+            distance    --- Maximum Hamming distance of simhashes in a cluster.
+
+        """
+        self.interval = interval
+        self.size = max(1, size)
+        self.min_length = min_length
+        self.distance = distance
+        self.clusters = OrderedDict()
+        self._exact = {}
+        self._bands = {}
+        self._next_id = 0
+
+    @classmethod
+    def normalize(cls, text):
+        """ Return list of words of the text with stripped diacritics, punctuation and collapsed digits """
+        text = text.lower()
+        if max(text or " ") > "\x7f":
+            text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+        return cls._word_re.findall(cls._digit_re.sub("0", text))
+
+    @classmethod
+    def simhash(cls, features):
+        """ Return 64-bit simhash of the features """
+        features = features[:255]
+        cache = cls._features
+        lanes = 0
+        for feature in features:
+            spread = cache.get(feature)
+            if spread is None:
+                if len(cache) >= cls._max_features:
+                    cache.clear()
+                value = hash(feature) & cls.mask
+                spread = cache[feature] = sum(cls.spread[(value >> (8 * byte)) & 255] << (64 * byte) for byte in range(8))
+            lanes += spread
+        result = 0
+        half = len(features)
+        for bit, count in enumerate(lanes.to_bytes(64, "little")):
+            if 2 * count > half:
+                result |= 1 << bit
+        return result
+
+    def add(self, now, text, jid, nick):
+        """
+        Add the message to its cluster and return the cluster (None if the text is too short).
+
+        Arguments:
+            now         --- Current timestamp.
+            text        --- Text of the message.
+            jid         --- JID of the sender.
+            nick        --- Nick of the sender.
+
+        """
+        words = self.normalize(text)
+        joined = "".join(words)
+        if len(joined) < self.min_length:
+            return None
+
+        exact = hash(joined)
+        cluster = self.clusters.get(self._exact.get(exact))
+        if cluster is None:
+            if len(words) >= 4:
+                features = words
+            else:
+                features = [joined[i:i+4] for i in range(len(joined) - 3)]
+            simhash = self.simhash(features)
+            bands = [(band, (simhash >> (8 * band)) & 255) for band in range(8)]
+            for key in bands:
+                for cluster_id in self._bands.get(key, ()):
+                    candidate = self.clusters[cluster_id]
+                    if bin(candidate.simhash ^ simhash).count("1") <= self.distance:
+                        cluster = candidate
+                        break
+                if cluster is not None:
+                    break
+            if cluster is None:
+                cluster = self._create(exact, simhash, bands)
+
+        cluster.messages.append((now, jid, nick))
+        age = now - self.interval
+        while cluster.messages[0][0] < age:
+            cluster.messages.popleft()
+        self.clusters.move_to_end(cluster.id)
+        return cluster
+
+    def expire(self, now):
+        """
+        Drop the clusters without messages in the interval.
+
+        Arguments:
+            now         --- Current timestamp.
+
+        """
+        age = now - self.interval
+        while len(self.clusters) > 0:
+            cluster = next(iter(self.clusters.values()))
+            if cluster.messages[-1][0] >= age:
+                break
+            self._remove(cluster)
+
+    def _create(self, exact, simhash, bands):
+        while len(self.clusters) >= self.size:
+            self._remove(next(iter(self.clusters.values())))
+        cluster = self.Cluster(self._next_id, exact, simhash)
+        self._next_id += 1
+        self.clusters[cluster.id] = cluster
+        self._exact[exact] = cluster.id
+        for key in bands:
+            self._bands.setdefault(key, set()).add(cluster.id)
+        return cluster
+
+    def _remove(self, cluster):
+        del self.clusters[cluster.id]
+        if self._exact.get(cluster.exact) == cluster.id:
+            del self._exact[cluster.exact]
+        for band in range(8):
+            key = (band, (cluster.simhash >> (8 * band)) & 255)
+            ids = self._bands.get(key)
+            if ids is not None:
+                ids.discard(cluster.id)
+                if len(ids) == 0:
+                    del self._bands[key]
+
+
+class ActionQueue:
+    """
+    Queue of moderation actions sent shortly after being queued.
+    Duplicate actions (the same room, kind and target) are coalesced, the same action is not repeated for a while.
+    Actions of the same room, kind and reason are sent asynchronously in a single muc#admin IQ.
+
+    Attributes:
+        delay       --- Number of seconds to collect the actions before sending them.
+        batch       --- Maximum number of items in a single IQ.
+        pending     --- Dictionary (room, kind, target) -> (value, reason) of queued actions.
+
+    Methods:
+        add         --- Queue the action.
+        flush       --- Send all queued actions.
+
+    """
+
+    # Stronger values replace the weaker ones for the same target
+    strength = {"visitor": 1, "none": 2, "outcast": 3}
+
+    def __init__(self, xep_0045, schedule, delay=0.5, memory=60, batch=50):
+        """
+        Arguments:
+            xep_0045    --- xep_0045 plugin instance.
+            schedule    --- Scheduler function of the bot.
+
+        Keyworded arguments:
+            delay       --- Number of seconds to collect the actions before sending them.
+            memory      --- Number of seconds the sent actions are not repeated.
+            batch       --- Maximum number of items in a single IQ.
+
+        """
+        self.xep_0045 = xep_0045
+        self.schedule = schedule
+        self.delay = delay
+        self.memory = memory
+        self.batch = max(1, batch)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._sent = {}
+
+    def add(self, room, kind, target, value, reason=None):
+        """
+        Queue the action.
+
+        Arguments:
+            room        --- Room JID.
+            kind        --- Type of the action: role or affiliation.
+            target      --- Nick (role) or JID (affiliation) of the user.
+            value       --- New role or affiliation.
+
+        Keyworded arguments:
+            reason      --- Reason of the action.
+
+        """
+        key = (room, kind, target)
+        with self.lock:
+            sent = self._sent.get(key)
+            if sent is not None and sent[0] > time.time() - self.memory and self.strength.get(sent[1], 0) >= self.strength.get(value, 0):
+                return
+            queued = self.pending.get(key)
+            if queued is not None and self.strength.get(queued[0], 0) >= self.strength.get(value, 0):
+                return
+            if len(self.pending) == 0:
+                self.schedule("antispam_actions", self.delay, self.flush)
+            self.pending[key] = (value, reason)
+
+    def flush(self):
+        """
+        Send all queued actions, grouped to as few IQs as possible.
+
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            now = time.time()
+            for key in [key for key, item in self._sent.items() if item[0] < now - self.memory]:
+                del self._sent[key]
+            for key, (value, reason) in pending.items():
+                self._sent[key] = (now, value)
+        groups = {}
+        for (room, kind, target), (value, reason) in sorted(pending.items()):
+            groups.setdefault((room, kind, reason), []).append((target, value))
+        for (room, kind, reason), items in groups.items():
+            for start in range(0, len(items), self.batch):
+                self._send(room, kind, items[start:start + self.batch], reason)
+
+    def _send(self, room, kind, items, reason):
+        """ Send the items in a single asynchronous IQ """
+        def callback(result):
+            if result["type"] == "result":
+                return
+            log.warn(_("Batch of {} {} changes in {} FAILED, retrying them one by one.").format(len(items), kind, room))
+            # The whole IQ fails if any item is rejected (e.g. user already left), blocking sends need own thread
+            thread = threading.Thread(target=self._send_single, args=(room, kind, items, reason), name="antispam_actions")
+            thread.daemon = True
+            thread.start()
+
+        if kind == "role":
+            self.xep_0045.setRoles(room, items, reason=reason, callback=callback)
+        else:
+            self.xep_0045.setAffiliations(room, items, reason=reason, callback=callback)
+
+    def _send_single(self, room, kind, items, reason):
+        for target, value in items:
+            if kind == "role":
+                self.xep_0045.setRole(room, nick=target, role=value, reason=reason)
+            else:
+                self.xep_0045.setAffiliation(room, jid=target, affiliation=value, reason=reason)
+
+
 class antispam:
     sleek_plugins = ("xep_0045",)
     limit_types = {}
     rooms = {}
 
+    muc_user = "{http://jabber.org/protocol/muc#user}"
+    _digits_re = re.compile(r"\d+")
+    # Maximum number of remembered occupants per room
+    max_present = 5000
+
     def __init__(self, bot, config):
+        self.schedule = bot.schedule
+        self.send_message = bot.send_message
         self.get_user_config = bot.get_user_config
         self.gettext = bot.gettext
         self.ngettext = bot.ngettext
+        self.actions = ActionQueue(self.xep_0045, self.schedule)
 
         self.limit_types["message"] = self.limit_message
         self.limit_types["character"] = self.limit_character
@@ -45,7 +415,32 @@ class antispam:
                     muc["limit"].remove(limit)
                     continue
 
-            if len(muc.get("limit", [])) == 0:
+            fingerprint = None
+            if "fingerprint" in muc:
+                fingerprint = muc["fingerprint"][0]
+                try:
+                    for attr, default in (("interval", 60), ("limit", 4), ("repeat", 2), ("expiration", 300), ("length", 20), ("window", 500)):
+                        fingerprint[attr] = int(fingerprint.get(attr, default))
+                except:
+                    log.error(_("Configuration error - {} attribute of fingerprint must be digit.").format(attr))
+                    fingerprint = None
+
+            presence = None
+            if "presence" in muc:
+                presence = muc["presence"][0]
+                try:
+                    for attr, default in (("interval", 10), ("joins", 0), ("domain", 0), ("pattern", 0), ("nicks", 0), ("expiration", 300), ("rejoin", 300)):
+                        presence[attr] = int(presence.get(attr, default))
+                except:
+                    log.error(_("Configuration error - {} attribute of presence must be digit.").format(attr))
+                    presence = None
+                else:
+                    presence["action"] = presence.get("action", "kick")
+                    if presence["action"] not in ("kick", "ban"):
+                        log.error(_("Configuration error - action attribute of presence must be kick or ban."))
+                        presence = None
+
+            if len(muc.get("limit", [])) == 0 and fingerprint is None and presence is None:
                 log.error(_("Configuration error - no limits given."))
                 continue
 
@@ -55,15 +450,80 @@ class antispam:
 
             conf = self.rooms[muc["room"]] = {}
             conf["noban"] = "noban" in muc
-            conf["limits"] = list(muc["limit"])
+            conf["limits"] = list(muc.get("limit", []))
             conf["spammers"] = {}
             conf["history"] = {}
+            conf["fingerprint"] = fingerprint
+            conf["presence"] = presence
+            conf["limits_all"] = list(conf["limits"])
+            if fingerprint is not None:
+                conf["fingerprints"] = FingerprintWindow(fingerprint["interval"], fingerprint["window"], fingerprint["length"])
+                conf["limits_all"].append(fingerprint)
+            if presence is not None:
+                # Join counters of the room, domains and patterns
+                conf["joins"] = {}
+                # deque of recent (timestamp, jid, nick, rejoin)
+                conf["joiners"] = deque(maxlen=1000)
+                # user key -> WindowCounter
+                conf["nick_changes"] = {}
+                # new nick -> timestamp of the nick change
+                conf["renaming"] = {}
+                # OrderedDict user key -> time the user joined the room (0 if unknown), the earliest first
+                conf["present"] = OrderedDict()
+                # OrderedDict user key -> time the user left the room, the earliest first
+                conf["departed"] = OrderedDict()
+                conf["lockdown"] = 0
+                conf["limits_all"].append(presence)
+            conf["max_interval"] = max(limit["interval"] for limit in conf["limits_all"])
+            conf["max_expiration"] = max(limit["expiration"] for limit in conf["limits_all"])
             log.info(_("Enabling spam protection in room {}.").format(muc["room"]))
             bot.add_event_handler("muc::{}::message".format(muc["room"]), self.check_spam, threaded=False)
+            if presence is not None:
+                bot.add_event_handler("muc::{}::presence".format(muc["room"]), self.check_presence, threaded=False)
+                bot.add_event_handler("muc::{}::got_online".format(muc["room"]), self.check_join, threaded=False)
+
+        self.running = True
+        if len(self.rooms) > 0:
+            self.cleanup_interval = max(10, min(conf["max_interval"] for conf in self.rooms.values()))
+            self.schedule("antispam_cleanup", self.cleanup_interval, self.cleanup)
 
     def shutdown(self, bot):
-        for room in self.rooms:
+        self.running = False
+        for room, conf in self.rooms.items():
             bot.del_event_handler("muc::{}::message".format(room), self.check_spam)
+            if conf["presence"] is not None:
+                bot.del_event_handler("muc::{}::presence".format(room), self.check_presence)
+                bot.del_event_handler("muc::{}::got_online".format(room), self.check_join)
+
+    def cleanup(self):
+        """ Forget idle users and expired spammers, rescheduled until shutdown. """
+        if not self.running:
+            return
+        now = time.time()
+        for conf in self.rooms.values():
+            history = conf["history"]
+            for jid in list(history.keys()):
+                if sum(counter.expire(now) for counter in history[jid]) == 0:
+                    del history[jid]
+            if conf["fingerprint"] is not None:
+                conf["fingerprints"].expire(now)
+            if conf["presence"] is not None:
+                for counters in (conf["joins"], conf["nick_changes"]):
+                    for key in list(counters.keys()):
+                        if counters[key].expire(now) == 0:
+                            del counters[key]
+                renaming = conf["renaming"]
+                for nick in list(renaming.keys()):
+                    if renaming[nick] < now - conf["presence"]["interval"]:
+                        del renaming[nick]
+                self.expire_departed(conf, now)
+            age = now - conf["max_expiration"]
+            spammers = conf["spammers"]
+            for jid in list(spammers.keys()):
+                if spammers[jid][0] < age:
+                    del spammers[jid]
+            log.debug(_("Got {} users in history and {} in spammers.").format(len(history), len(spammers)))
+        self.schedule("antispam_cleanup", self.cleanup_interval, self.cleanup)
 
     def limit_message(self, item):
         return 1
@@ -95,57 +555,222 @@ class antispam:
 
         jid = str(self.xep_0045.getJidProperty(room, nick, "jid"))
         now = int(time.time())
-        noban = self.rooms[room]["noban"]
-        limits = self.rooms[room]["limits"]
-        spammers = self.rooms[room]["spammers"]
-        history = self.rooms[room]["history"]
-        if jid not in history:
-            history[jid] = []
-        history[jid].append((now, msg.get("body", "")))
-
-        max_interval = 0
-        max_expiration = 0
+        conf = self.rooms[room]
+        limits = conf["limits"]
+        history = conf["history"]
+        counters = history.get(jid)
+        if counters is None:
+            counters = history[jid] = [WindowCounter(limit["interval"]) for limit in limits]
+        item = (now, msg.get("body", ""))
+
         action = None
-        for limit in limits:
-            max_interval = max(limit["interval"], max_interval)
-            max_expiration = max(limit["expiration"], max_expiration)
+        for limit, counter in zip(limits, counters):
+            count = counter.add(now, self.limit_types[limit["type"]](item))
             if action is not None:
                 # We have already taken some action -> ignore the remaining limits
                 continue
-            age = now - limit["interval"]
-            count = 0
-            callback = self.limit_types[limit["type"]]
-            for item in history[jid]:
-                if item[0] >= age:
-                    count += callback(item)
             if count >= limit["limit"]:
-                age = now - limit["expiration"]
-                if jid not in spammers or spammers[jid][0] < age:
-                    action = "warn"
-                    log.info(_("Warning {!r} in room {}.").format(nick, room))
-                    uc = self.get_user_config(msg["from"])
-                    msg.reply(nick + ": " + self.gettext("Stop spamming!", uc.lang)).send()
-                elif spammers[jid][1] == "warn" or noban or bot_affiliation not in ("admin", "owner"):
-                    action = "kick"
-                    log.info(_("Kicking {!r} from room {}.").format(jid, room))
-                    self.xep_0045.setRole(room, jid=jid, role="none", reason="spam")
-                else:
-                    action = "ban"
-                    log.warn(_("Banning {!r} from room {}.").format(jid, room))
-                    return self.xep_0045.setAffiliation(room, jid=jid, affiliation="outcast", reason="spam")
-                spammers[jid] = (now, action)
-
-        # Cleanup
-        age = now - max_interval
-        for jid in list(history.keys()):
-            if history[jid][-1][0] < age:
-                del history[jid]
+                action = self.punish(msg, room, nick, jid, limit["expiration"], now)
+                if action == "ban":
+                    return
+
+        fingerprint = conf["fingerprint"]
+        if fingerprint is None:
+            return
+        cluster = conf["fingerprints"].add(now, item[1], jid, nick)
+        if cluster is None:
+            return
+        # Ordinary chat (greetings, "+1") is said once per user, flooders repeat the message
+        senders = cluster.senders(fingerprint["repeat"])
+        if len(senders) < fingerprint["limit"]:
+            return
+        # The same text repeated by many users -> punish all of them, once per cluster
+        log.info(_("Detected flood of {} users with the same message in room {}.").format(len(senders), room))
+        if action is not None:
+            # The sender of this message was already punished by the limits
+            cluster.punished.add(jid)
+        for sender_jid, sender_nick in senders.items():
+            if sender_jid in cluster.punished:
+                continue
+            cluster.punished.add(sender_jid)
+            self.punish(msg, room, sender_nick, sender_jid, fingerprint["expiration"], now)
+
+    def punish(self, stanza, room, nick, jid, expiration, now):
+        """
+        Warn, kick or ban the spammer according to his previous offences, return the action taken.
+
+        Arguments:
+            stanza      --- Message or presence triggering the action.
+            room        --- Room JID.
+            nick        --- Nick of the spammer.
+            jid         --- JID of the spammer.
+            expiration  --- Number of seconds the offence is remembered.
+            now         --- Current timestamp.
+
+        """
+        conf = self.rooms[room]
+        spammers = conf["spammers"]
+        bot_nick = self.xep_0045.ourNicks.get(room, "")
+        bot_affiliation = self.xep_0045.getJidProperty(room, bot_nick, "affiliation")
+        age = now - expiration
+        if jid not in spammers or spammers[jid][0] < age:
+            action = "warn"
+            log.info(_("Warning {!r} in room {}.").format(nick, room))
+            uc = self.get_user_config(stanza["from"])
+            self.send_message(mto=room, mbody=nick + ": " + self.gettext("Stop spamming!", uc.lang), mtype="groupchat")
+        elif spammers[jid][1] == "warn" or conf["noban"] or bot_affiliation not in ("admin", "owner"):
+            action = "kick"
+            log.info(_("Kicking {!r} from room {}.").format(jid, room))
+            self.actions.add(room, "role", nick, "none", "spam")
+        else:
+            log.warn(_("Banning {!r} from room {}.").format(jid, room))
+            self.actions.add(room, "affiliation", jid, "outcast", "spam")
+            return "ban"
+        spammers[jid] = (now, action)
+        return action
+
+    def is_protected(self, room, nick, affiliation=None, role=None):
+        """ Test if the user is exempt from the presence limits (or we lack the rights). """
+        bot_nick = self.xep_0045.ourNicks.get(room, "")
+        if nick in ("", bot_nick) or room not in self.xep_0045.getJoinedRooms():
+            return True
+        if self.xep_0045.getJidProperty(room, bot_nick, "role") != "moderator":
+            return True
+        return affiliation in ("member", "admin", "owner") or role == "moderator"
+
+    def jid_keys(self, jid):
+        """ Return domain and pattern (digits replaced) keys of the JID """
+        bare = jid.split("/", 1)[0]
+        if "@" in bare:
+            local, domain = bare.split("@", 1)
+        else:
+            local, domain = "", bare
+        if self._digits_re.search(local) is None:
+            # The pattern would match just this one user
+            return (("domain", domain),)
+        return ("domain", domain), ("pattern", "{}@{}".format(self._digits_re.sub("#", local), domain))
+
+    def user_key(self, jid, nick):
+        """ Return key identifying the user across rejoins """
+        if jid != "":
+            return ("jid", jid.split("/", 1)[0])
+        return ("nick", nick)
+
+    def expire_departed(self, conf, now):
+        """ Forget users that left the room before the rejoin period """
+        departed = conf["departed"]
+        age = now - conf["presence"]["rejoin"]
+        while len(departed) > 0:
+            key, left = next(iter(departed.items()))
+            if left >= age and len(departed) <= 1000:
+                break
+            del departed[key]
+
+    def check_presence(self, pr):
+        """ Keep track of nick changes and users leaving the room. """
+        if pr["type"] != "unavailable":
+            return
+        room = pr["muc"]["room"]
+        nick = pr["muc"]["nick"]
+        if self.is_protected(room, nick, pr["muc"]["affiliation"], pr["muc"]["role"]):
+            return
+        jid = str(pr["muc"]["jid"])
+        conf = self.rooms[room]
+        presence = conf["presence"]
+        now = int(time.time())
+        key = self.user_key(jid, nick)
+        joined = conf["present"].pop(key, 0)
+        codes = set(status.get("code") for status in pr.xml.findall("{0}x/{0}status".format(self.muc_user)))
+        if "303" not in codes:
+            # Rejoin (e.g. after netsplit or reconnect) of a user that stayed in the room for a while
+            # is not counted in domain and pattern limits, unless the user was kicked or banned
+            if presence["rejoin"] > 0 and now - joined >= presence["interval"] and len(codes & set(("301", "307"))) == 0:
+                conf["departed"].pop(key, None)
+                conf["departed"][key] = now
+                self.expire_departed(conf, now)
+            return
+
+        # Nick change, the next presence of the new nick is not a join
+        new_nick = None
+        for item in pr.xml.findall("{0}x/{0}item".format(self.muc_user)):
+            new_nick = item.get("nick")
+        if new_nick is None:
+            return
+        conf["renaming"][new_nick] = now
+        counter = conf["nick_changes"].pop(key, None)
+        new_key = self.user_key(jid, new_nick)
+        conf["present"][new_key] = joined
+        if presence["nicks"] <= 0:
+            return
+        if counter is None:
+            counter = WindowCounter(presence["interval"])
+        # Without JID the user is followed from nick to nick
+        conf["nick_changes"][new_key] = counter
+        if counter.add(now) >= presence["nicks"]:
+            log.info(_("Too many nick changes of {!r} in room {}.").format(jid or new_nick, room))
+            # Act on the new nick, the old one is leaving
+            self.punish(pr, room, new_nick, jid, presence["expiration"], now)
+
+    def check_join(self, pr):
+        """ Keep track of joins to the room, per domain and JID pattern. """
+        room = pr["muc"]["room"]
+        nick = pr["muc"]["nick"]
+        if self.is_protected(room, nick, pr["muc"]["affiliation"], pr["muc"]["role"]):
+            return
+        conf = self.rooms[room]
+        presence = conf["presence"]
+        jid = str(pr["muc"]["jid"])
+        if conf["renaming"].pop(nick, None) is not None:
+            # Nick change, not a join
+            return
+
+        now = int(time.time())
+        key = self.user_key(jid, nick)
+        conf["present"].pop(key, None)
+        conf["present"][key] = now
+        while len(conf["present"]) > self.max_present:
+            conf["present"].popitem(last=False)
+        left = conf["departed"].pop(key, None)
+        rejoin = left is not None and left >= now - presence["rejoin"]
+
+        joins = conf["joins"]
+        conf["joiners"].append((now, jid, nick, rejoin))
+        keys = [("room", room)]
+        if jid != "" and not rejoin:
+            # Rejoins count only in the room limit
+            keys.extend(self.jid_keys(jid))
+        for key in keys:
+            limit = presence["joins" if key[0] == "room" else key[0]]
+            if limit <= 0:
+                continue
+            counter = joins.get(key)
+            if counter is None:
+                counter = joins[key] = WindowCounter(presence["interval"])
+            if counter.add(now) < limit:
+                continue
+            if key[0] == "room":
+                if conf["lockdown"] < now:
+                    log.warn(_("Join flood in room {}, revoking voice of newcomers for {} seconds.").format(room, presence["expiration"]))
+                conf["lockdown"] = now + presence["expiration"]
+            else:
+                log.warn(_("Join flood from {} {!r} in room {}.").format(key[0], key[1], room))
+                self.punish_joiners(room, key, now)
+
+        if conf["lockdown"] >= now:
+            for joined, joiner_jid, joiner_nick, joiner_rejoin in conf["joiners"]:
+                if joined >= now - presence["interval"]:
+                    self.actions.add(room, "role", joiner_nick, "visitor", "join flood")
+
+    def punish_joiners(self, room, key, now):
+        """ Kick or ban all recent joiners matching the key """
+        conf = self.rooms[room]
+        presence = conf["presence"]
+        bot_affiliation = self.xep_0045.getJidProperty(room, self.xep_0045.ourNicks.get(room, ""), "affiliation")
+        ban = presence["action"] == "ban" and not conf["noban"] and bot_affiliation in ("admin", "owner")
+        for joined, jid, nick, rejoin in conf["joiners"]:
+            if joined < now - presence["interval"] or rejoin or jid == "" or key not in self.jid_keys(jid):
+                continue
+            if ban:
+                self.actions.add(room, "affiliation", jid.split("/", 1)[0], "outcast", "join flood")
             else:
-                while len(history[jid]) > 0 and history[jid][0][0] < age:
-                    del history[jid][0]
-        age = now - max_expiration
-        for jid in list(spammers.keys()):
-            if spammers[jid][0] < age:
-                del spammers[jid]
-
-        log.debug(_("Got {} users in history and {} in spammers.").format(len(history), len(spammers)))
+                self.actions.add(room, "role", nick, "none", "join flood")
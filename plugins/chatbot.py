@@ -12,14 +12,24 @@ __license__ = "GPL 3.0"
 __version__ = "0.5.0"
 
 
+import bisect
+from collections import deque, OrderedDict
 import datetime
 import glob
 import logging
+import os
 import os.path
+import pickle
+import queue
 import random
 import re
+import threading
 import time
 from xml.etree import cElementTree as ET
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
 
 log = logging.getLogger(__name__)
 __ = lambda x: x # Fake gettext function
@@ -28,9 +38,7 @@ __ = lambda x: x # Fake gettext function
 class chatbot:
     dictionary_files = []
     states_muc = {}
-    states_jid = {}
     rooms = {}
-    msg_times = {}
     logger = None
 
     def __init__(self, bot, config):
@@ -39,31 +47,36 @@ class chatbot:
         self.get_command_level = bot.get_command_level
         self.get_our_nick = bot.get_our_nick
         self.get_user_config = bot.get_user_config
-        self.schedule = bot.schedule
-        self.send_message = bot.send_message
         self.gettext = bot.gettext
         self.ngettext = bot.ngettext
         self.filters = Filters(bot)
+        self.pacer = Pacer(bot.schedule, bot.send_message, int(config.get("config", {}).get("queue", 10)))
 
+        state_ttl = int(config.get("config", {}).get("state_ttl", 2*3600))
+        state_size = int(config.get("config", {}).get("state_size", 1000))
+        self.states_jid = States(state_ttl, state_size, dict)
         for muc in config.get("muc", []):
             room = muc.get("room")
             if room is None:
                 log.error(_("Configuration error - room attribute of muc required."))
                 continue
-            self.states_muc[room] = {}
+            self.states_muc[room] = States(state_ttl, state_size, lambda: {"private":{}, "public":{}})
+            # recent: nicks with public state, in the order of their last response
             if "disabled" in muc:
                 log.debug(_("NOT starting to chat in room {}").format(room))
-                self.rooms[room] = {"chatty":False, "msg_counter":0}
+                self.rooms[room] = {"chatty":False, "msg_counter":0, "recent":OrderedDict(), "lang":muc.get("lang")}
             else:
                 log.debug(_("Starting to chat in room {}").format(room))
-                self.rooms[room] = {"chatty":True, "msg_counter":0}
+                self.rooms[room] = {"chatty":True, "msg_counter":0, "recent":OrderedDict(), "lang":muc.get("lang")}
 
         for dictionary in config.get("dict", []):
             if "path" not in dictionary:
                 log.error(_("Configuration error - path attribute of dictionary required."))
                 continue
-            self.dictionary_files.append(dictionary["path"])
-        self.conversations = Conversations(self.dictionary_files)
+            self.dictionary_files.append((dictionary["path"], dictionary.get("lang")))
+        self.cache_file = config.get("config", {}).get("cache")
+        self.memo_size = int(config.get("config", {}).get("memo", 1000))
+        self.conversations = Conversations(self.dictionary_files, self.cache_file, memo_size=self.memo_size)
 
         log_path = config.get("config", {}).get("log")
         if log_path is not None:
@@ -76,6 +89,8 @@ class chatbot:
 
     def shutdown(self, bot):
         bot.del_event_handler("message", self.handle_message)
+        if self.logger is not None:
+            self.logger.shutdown()
 
     def chat(self, command, args, msg, uc):
         if args == "":
@@ -93,13 +108,18 @@ class chatbot:
 
         if args in self.rooms:
             self.rooms[args]["chatty"] = False
+            self.pacer.cancel(args)
             return self.gettext("OK, I'll stop chatting in room {}.", uc.lang).format(args)
         else:
             return self.gettext("Sorry, I don't chat in room {} at all.", uc.lang).format(args)
 
     def reload(self, command, args, msg, uc):
-        self.conversations = Conversations(self.dictionary_files)
-        log.info(_("Conversation files reloaded."))
+        # Responses in progress keep using the old table
+        conversations = Conversations(self.dictionary_files, self.cache_file, self.conversations, self.memo_size)
+        hits, misses, size = self.conversations.get_memo_stats()
+        self.conversations = conversations
+        log.info(_("Conversation files reloaded, {} of {} parsed again.").format(conversations.parsed, len(conversations.files)))
+        log.info(_("Memoized matching of the old conversations: {} hits, {} misses, {} entries.").format(hits, misses, size))
         return self.gettext("OK, I've reloaded conversation files ;-)", uc.lang)
 
     def handle_message(self, msg):
@@ -121,8 +141,15 @@ class chatbot:
                 message, state = self._prepare_response_pm(msg)
                 state_others = []
 
+        if msg["type"] == "groupchat":
+            lang = self.rooms[msg["mucroom"]]["lang"]
+        else:
+            lang = self.rooms.get(msg["from"].bare, {}).get("lang")
+        if lang is None:
+            lang = self.get_user_config(msg["from"]).lang
+
         log.debug(flags)
-        response, state_new, filters = self.conversations.get_response(state, state_others, message, flags)
+        response, state_new, filters = self.conversations.get_response(state, state_others, message, flags, lang)
         if self.logger is not None:
             self.logger.log(msg, response)
 
@@ -131,6 +158,9 @@ class chatbot:
                 room = msg["mucroom"]
                 nick = msg["mucnick"]
                 self.states_muc[room][nick]["public"] = {"msg_timer":time.time(), "msg_counter":msg_counter, "state":state_new}
+                recent = self.rooms[room]["recent"]
+                recent.pop(nick, None)
+                recent[nick] = True
                 if "direct" in flags and "direct" not in filters:
                     filters.append("direct")
             elif msg["from"].bare in self.rooms:
@@ -155,11 +185,12 @@ class chatbot:
         else:
             mtype = "chat"
             mto = msg["from"].full
-        now = time.time()
+        lines = []
         for prefix, response in self._parse_multiline(prefix, response):
-            wait = random.uniform(min(8, max(1, len(response)/9)), min(25, max(5, len(response)/6))) + max(0, self.msg_times.get(mto, 0) - now)
-            self.msg_times[mto] = now + wait
-            self.schedule("chatbot_message", wait, self.send_message, (mto, prefix+response, None, mtype))
+            # Time to "type" the line
+            delay = random.uniform(min(8, max(1, len(response)/9)), min(25, max(5, len(response)/6)))
+            lines.append((delay, prefix+response))
+        self.pacer.add(mto, mtype, lines)
 
     def _parse_multiline(self, prefix, response):
         """ Parses | out into multiple strings and actions. """
@@ -226,25 +257,30 @@ class chatbot:
             flags = ["chat", "global", "public"]
 
         states = self.states_muc[room]
-        if nick not in states:
-            states[nick] = {"private":{}, "public":{}}
+        user_state = states.get(nick)
 
-        msg_counter_old = states[nick]["public"].get("msg_counter", None)
-        msg_timer_old = states[nick]["public"].get("msg_timer", None)
+        msg_counter_old = user_state["public"].get("msg_counter", None)
+        msg_timer_old = user_state["public"].get("msg_timer", None)
         state = []
         if msg_counter_old is not None and (msg_counter - msg_counter_old) <= 30 and msg_timer_old is not None and (time.time() - msg_timer_old) <= 2*3600:
-            state = states[nick]["public"].get("state", [])
+            state = user_state["public"].get("state", [])
         else:
-            states[nick]["public"]["state"] = []
+            user_state["public"]["state"] = []
+
+        # Nicks are ordered by their last response, so the stale ones are at the front
+        recent = self.rooms[room]["recent"]
+        while len(recent) > 0:
+            name = next(iter(recent))
+            public = states.peek(name, {}).get("public", {})
+            if public.get("msg_counter") is not None and (msg_counter - public["msg_counter"]) <= 5 and (time.time() - public["msg_timer"]) <= 1800:
+                break
+            del recent[name]
 
         state_others = []
-        for name in states:
-            if name == nick:
-                continue
-            msg_counter_old = states[name]["public"].get("msg_counter", None)
-            msg_timer_old = states[name]["public"].get("msg_timer", None)
-            if msg_counter_old is not None and (msg_counter - msg_counter_old) <= 5 and msg_timer_old is not None and (time.time() - msg_timer_old) <= 1800:
-                state_others.extend(states[name]["public"].get("state", []))
+        for name in recent:
+            other_state = states.peek(name)
+            if name != nick and other_state is not None:
+                state_others.extend(other_state["public"].get("state", []))
 
         return message, flags, state, state_others
 
@@ -254,21 +290,19 @@ class chatbot:
         room = msg["from"].bare
         nick = msg["from"].resource
 
-        states = self.states_muc[room]
-        if nick not in states:
-            states[nick] = {"private":{}, "public":{}}
+        user_state = self.states_muc[room].get(nick)
 
-        msg_timer_old = states[nick]["private"].get("msg_timer", None)
+        msg_timer_old = user_state["private"].get("msg_timer", None)
         state = []
         if msg_timer_old is not None and (time.time() - msg_timer_old) <= 2*3600:
-            state = states[nick]["private"].get("state", [])
+            state = user_state["private"].get("state", [])
         else:
-            states[nick]["private"]["state"] = []
+            user_state["private"]["state"] = []
 
         state_others = []
-        msg_timer_old = states[nick]["public"].get("msg_timer", None)
+        msg_timer_old = user_state["public"].get("msg_timer", None)
         if msg_timer_old is not None and (time.time() - msg_timer_old) <= 1800:
-            state_others.extend(states[nick]["public"].get("state", []))
+            state_others.extend(user_state["public"].get("state", []))
 
         return message, state, state_others
 
@@ -277,16 +311,14 @@ class chatbot:
         message = msg.get("body", "")
         jid = msg["from"].bare
 
-        states = self.states_jid
-        if jid not in states:
-            states[jid] = {}
+        user_state = self.states_jid.get(jid)
 
-        msg_timer_old = states[jid].get("msg_timer", None)
+        msg_timer_old = user_state.get("msg_timer", None)
         state = []
         if msg_timer_old is not None and (time.time() - msg_timer_old) <= 2*3600:
-            state = states[jid].get("state", [])
+            state = user_state.get("state", [])
         else:
-            states[jid]["state"] = []
+            user_state["state"] = []
 
         return message, state
 
@@ -305,6 +337,187 @@ class chatbot:
         return prefix, response
 
 
+class Pacer:
+    """
+    Outbound pacing of replies.
+    Every destination has its own queue of lines, each line is sent its delay after the previous one. The scheduler
+    holds at most one task per destination, lines queued while it's pending just wait for it.
+
+    Attributes:
+        max_lines   --- Maximum number of queued lines per destination, further lines are dropped.
+
+    Methods:
+        add         --- Queue lines for the destination.
+        cancel      --- Drop all queued lines of the destination.
+
+    """
+
+    def __init__(self, schedule, send_message, max_lines=10):
+        """
+        Arguments:
+            schedule        --- Scheduler function of the bot.
+            send_message    --- Function sending the message.
+
+        Keyworded arguments:
+            max_lines       --- Maximum number of queued lines per destination.
+
+        """
+        self.schedule = schedule
+        self.send_message = send_message
+        self.max_lines = max(1, max_lines)
+        self.lock = threading.Lock()
+        # mto -> {"lines":deque of (delay, text, mtype), "due":time to send the first line, "timer":task pending?}
+        self._destinations = {}
+
+    def add(self, mto, mtype, lines):
+        """
+        Queue lines for the destination.
+
+        Arguments:
+            mto         --- Destination JID.
+            mtype       --- Message type.
+            lines       --- List of (delay, text).
+
+        """
+        with self.lock:
+            destination = self._destinations.get(mto)
+            if destination is None:
+                destination = self._destinations[mto] = {"lines":deque(), "due":None, "timer":False}
+            queued = destination["lines"]
+            for delay, text in lines:
+                if len(queued) >= self.max_lines:
+                    log.debug(_("Too many lines queued for {}, dropping the rest.").format(mto))
+                    break
+                queued.append((delay, text, mtype))
+            if destination["due"] is None and len(queued) > 0:
+                destination["due"] = time.time() + queued[0][0]
+                if not destination["timer"]:
+                    destination["timer"] = True
+                    self.schedule("chatbot_message_{}".format(mto), queued[0][0], self._send, (mto,))
+
+    def cancel(self, mto):
+        """
+        Drop all queued lines of the destination.
+
+        Arguments:
+            mto         --- Destination JID.
+
+        """
+        with self.lock:
+            destination = self._destinations.get(mto)
+            if destination is None:
+                return
+            destination["lines"].clear()
+            destination["due"] = None
+            if not destination["timer"]:
+                del self._destinations[mto]
+
+    def _send(self, mto):
+        """ Send the first line if it's due and schedule the next one """
+        with self.lock:
+            destination = self._destinations[mto]
+            queued = destination["lines"]
+            now = time.time()
+            if len(queued) == 0:
+                # Cancelled
+                del self._destinations[mto]
+                return
+            if destination["due"] > now + 0.01:
+                # Lines were cancelled and new ones queued before the task fired
+                self.schedule("chatbot_message_{}".format(mto), destination["due"] - now, self._send, (mto,))
+                return
+            delay, text, mtype = queued.popleft()
+            message = (mto, text, None, mtype)
+            if len(queued) > 0:
+                destination["due"] = now + queued[0][0]
+                self.schedule("chatbot_message_{}".format(mto), queued[0][0], self._send, (mto,))
+            else:
+                del self._destinations[mto]
+        self.send_message(*message)
+
+
+class States:
+    """
+    Conversation states of users, the least recently active ones are forgotten.
+
+    Attributes:
+        ttl         --- Number of seconds of inactivity after which the state is forgotten.
+        size        --- Maximum number of remembered states.
+        factory     --- Function creating an empty state.
+
+    Methods:
+        get         --- Return state of the user, create it if needed.
+        peek        --- Return state of the user without marking it active.
+
+    """
+
+    def __init__(self, ttl, size, factory):
+        """
+        Arguments:
+            ttl         --- Number of seconds of inactivity after which the state is forgotten.
+            size        --- Maximum number of remembered states.
+            factory     --- Function creating an empty state.
+
+        """
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.factory = factory
+        # key -> (last activity, state), least recently active first
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, key):
+        return key in self._states
+
+    def __getitem__(self, key):
+        return self._states[key][1]
+
+    def __setitem__(self, key, state):
+        self._states.pop(key, None)
+        self._states[key] = (time.time(), state)
+        self._expire()
+
+    def get(self, key):
+        """
+        Return state of the user and mark it active, create empty state if needed.
+
+        Arguments:
+            key         --- Nick or JID of the user.
+
+        """
+        item = self._states.pop(key, None)
+        state = self.factory() if item is None else item[1]
+        self._states[key] = (time.time(), state)
+        self._expire()
+        return state
+
+    def peek(self, key, default=None):
+        """
+        Return state of the user without marking it active.
+
+        Arguments:
+            key         --- Nick or JID of the user.
+
+        Keyworded arguments:
+            default     --- Value returned for unknown users.
+
+        """
+        item = self._states.get(key)
+        if item is None:
+            return default
+        return item[1]
+
+    def _expire(self):
+        limit = time.time() - self.ttl
+        while len(self._states) > 0:
+            key, (activity, state) = next(iter(self._states.items()))
+            if len(self._states) <= self.size and activity >= limit:
+                break
+            del self._states[key]
+
+
 class Filters:
     def __init__(self, bot):
         self.get_our_nick = bot.get_our_nick
@@ -334,18 +547,180 @@ class Filters:
         return prefix, response.replace("//DATE//", "{}.{}.".format(now.day, now.month))
 
 
-class Conversations:
-    queries = []
+class QueryMatcher:
+    """
+    Keyword prefilter of queries.
+    For every pattern a set of literal keywords is extracted, one of which must occur in any matching text. A single
+    regex pass finds keywords present in the text and only patterns of candidate queries are searched, in the list order.
+    Patterns without keywords are always candidates.
 
-    def __init__(self, filenames=[]):
-        files = []
+    Attributes:
+        queries     --- List of queries in the priority order.
+
+    Methods:
+        get_keywords    --- Extract keywords of the pattern.
+        matches         --- Iterate over indices of queries matching the text.
+
+    """
+
+    # Characters matched by ASCII letters in case-insensitive mode, but not lowercased to them
+    _fold = {ord("\u0131"):"i", ord("\u017f"):"s"}
+
+    def __init__(self, queries):
+        """
+        Arguments:
+            queries     --- List of queries in the priority order.
+
+        """
+        self.queries = queries
+        always = []
+        by_keyword = {}
+        for index, item in enumerate(queries):
+            if "keywords" in item:
+                keywords = item["keywords"]
+            else:
+                keywords = self.get_keywords(item["pattern"].pattern)
+            if keywords is None:
+                always.append(index)
+                continue
+            for keyword in keywords:
+                by_keyword.setdefault(keyword, []).append(index)
+        self._always = frozenset(always)
+        self._candidates = {}
+        self._keywords_re = None
+        if len(by_keyword) > 0:
+            # Longest keywords first, the shorter ones found at the same position are their prefixes
+            keywords = sorted(by_keyword, key=len, reverse=True)
+            self._keywords_re = re.compile("(?=({}))".format("|".join(re.escape(keyword) for keyword in keywords)))
+            for keyword in keywords:
+                candidates = set()
+                for prefix in keywords:
+                    if keyword.startswith(prefix):
+                        candidates.update(by_keyword[prefix])
+                self._candidates[keyword] = frozenset(candidates)
+
+    @classmethod
+    def get_keywords(cls, pattern):
+        """
+        Return set of lowercase keywords one of which must occur in the text matching the pattern, or None.
+
+        Arguments:
+            pattern     --- Regular expression.
+
+        """
+        try:
+            return cls._required(sre_parse.parse(pattern, re.I | re.U))
+        except Exception:
+            return None
+
+    @classmethod
+    def _required(cls, items):
+        best = []
+        def consider(keywords):
+            if keywords and (len(best) == 0 or min(map(len, keywords)) > min(map(len, best[0]))):
+                best[:] = [keywords]
+        run = ""
+        for op, av in items:
+            if op is sre_constants.LITERAL and av < 128 and (chr(av).isalnum() or chr(av) == " "):
+                run += chr(av).lower()
+                continue
+            consider({run} if run else None)
+            run = ""
+            if op is sre_constants.SUBPATTERN:
+                consider(cls._required(av[-1]))
+            elif op is sre_constants.BRANCH:
+                branches = [cls._required(branch) for branch in av[1]]
+                if all(branches):
+                    consider(set().union(*branches))
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+                consider(cls._required(av[2]))
+        consider({run} if run else None)
+        return best[0] if best else None
+
+    def matches(self, text):
+        """
+        Iterate over indices of queries matching the text, in the list order.
+
+        Arguments:
+            text        --- Text to match.
+
+        """
+        candidates = set(self._always)
+        if self._keywords_re is not None:
+            for keyword in set(self._keywords_re.findall(text.lower().translate(self._fold))):
+                candidates.update(self._candidates[keyword])
+        for index in sorted(candidates):
+            if self.queries[index]["pattern"].search(text) is not None:
+                yield index
+
+
+class Conversations:
+    # Flag sets used by chatbot, their tables are precomputed
+    flag_sets = (frozenset(("chat", "global", "public")),
+                 frozenset(("chat", "direct", "public")),
+                 frozenset(("chat", "direct", "private")))
+    # Bump when the structure of parsed queries changes
+    cache_version = 1
+
+    def __init__(self, filenames=[], cache_file=None, previous=None, memo_size=1000):
+        """
+        Keyworded arguments:
+            filenames   --- List of conversation files (glob patterns), or (glob pattern, language) pairs.
+                            Files without language are used for all languages.
+            cache_file  --- Path to the on-disk cache of parsed conversation files.
+            previous    --- Conversations instance, whose parsed files are reused if they didn't change.
+            memo_size   --- Maximum number of remembered matching queries of messages.
+
+        """
+        self.queries = []
+        self.matchers = {}
+        # (message, flags, lang) -> matching global query, most recently used last
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+        # filename -> ((mtime, size), queries)
+        self.files = {}
+        self.parsed = 0
+        # List of (language, queries) of the files
+        self.languages = []
+        files = {}
         for filename in filenames:
+            lang = None
+            if not isinstance(filename, str):
+                filename, lang = filename
             log.debug(filename)
-            files.extend(glob.glob(filename))
-        for filename in sorted(files):
-            self.load_file(filename)
+            for path in glob.glob(filename):
+                files[path] = lang
 
-    def load_file(self, filename):
+        if previous is not None:
+            cached = previous.files
+        else:
+            cached = self._read_cache(cache_file)
+        for filename in sorted(files):
+            try:
+                stamp = (os.path.getmtime(filename), os.path.getsize(filename))
+            except OSError:
+                log.exception(_("Could not stat conversation file {}.").format(filename))
+                continue
+            if filename in cached and cached[filename][0] == stamp:
+                self.files[filename] = cached[filename]
+                self.queries.extend(cached[filename][1])
+            else:
+                self.load_file(filename, stamp)
+            if filename in self.files:
+                self.languages.append((files[filename], self.files[filename][1]))
+        if cache_file is not None and (self.parsed > 0 or set(self.files) != set(cached)):
+            self._write_cache(cache_file)
+
+        self.langs = set(lang for lang, queries in self.languages if lang is not None)
+        for flags in self.flag_sets:
+            for lang in self.langs:
+                self.get_matcher(flags, lang)
+            if len(self.langs) == 0:
+                self.get_matcher(flags)
+
+    def load_file(self, filename, stamp=None):
         log.debug(_("Loading conversation file {}.").format(filename))
         root = ET.parse(filename)
         id_map = {}
@@ -353,7 +728,39 @@ class Conversations:
         data["queries"] = []
         self._parse_queries(root, data, id_map)
         self._replace_ids(id_map, data["queries"], "replies")
+        self._prepare_tables(data["queries"])
         self.queries.extend(data["queries"])
+        self.files[filename] = (stamp, data["queries"])
+        self.parsed += 1
+        self.matchers = {}
+
+    def _read_cache(self, cache_file):
+        """ Read parsed files from the on-disk cache """
+        if cache_file is None or not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, "rb") as fp:
+                data = pickle.load(fp)
+            if data.get("version") == self.cache_version:
+                return data["files"]
+            log.info(_("Conversation cache {} has old format, ignoring it.").format(cache_file))
+        except Exception:
+            log.exception(_("Could not read conversation cache {}.").format(cache_file))
+        return {}
+
+    def _write_cache(self, cache_file):
+        """ Atomically replace the on-disk cache of parsed files """
+        temp = cache_file + ".tmp"
+        try:
+            with open(temp, "wb") as fp:
+                pickle.dump({"version":self.cache_version, "files":self.files}, fp, pickle.HIGHEST_PROTOCOL)
+            if hasattr(os, "replace"):
+                os.replace(temp, cache_file)
+            else:
+                # Python 3.2, replaces the file on POSIX only
+                os.rename(temp, cache_file)
+        except Exception:
+            log.exception(_("Could not write conversation cache {}.").format(cache_file))
 
     def _parse_queries(self, element, context, id_map):
         for query in element.findall("query"):
@@ -361,6 +768,7 @@ class Conversations:
                 item = dict(query.attrib)
                 item["scope"] = item.get("scope", "direct")
                 item["pattern"] = re.compile(item.pop("match"),  re.I | re.U)
+                item["keywords"] = QueryMatcher.get_keywords(item["pattern"].pattern)
                 item["replies"] = []
                 if "id" in item:
                     id_map[item["id"]] = item
@@ -395,69 +803,257 @@ class Conversations:
                 else:
                     log.error(_("Could not find matching element with id {!r}.").format(extends))
 
-    def get_response(self, state, state_others, query, flags=["chat"]):
+    def _prepare_tables(self, queries):
+        """ Precompute reply tables of all (nested) queries for the known flag sets """
+        seen = set()
+        stack = list(queries)
+        while len(stack) > 0:
+            item = stack.pop()
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            item["reply_tables"] = {}
+            for flags in self.flag_sets:
+                self._get_replies_table(item, flags)
+            for reply in item["replies"]:
+                stack.extend(reply["queries"])
+
+    def _get_replies_table(self, item, flags):
+        """ Return replies of the query applicable with given flags and their cumulative weights """
+        tables = item.setdefault("reply_tables", {})
+        key = flags if isinstance(flags, frozenset) else frozenset(flags)
+        table = tables.get(key)
+        if table is None:
+            replies = [reply for reply in item["replies"] if reply["scope"] in key]
+            weights = []
+            sum_ = 0
+            for reply in replies:
+                sum_ += reply["weight"]
+                weights.append(sum_)
+            table = tables[key] = (replies, weights)
+        return table
+
+    def get_matcher(self, flags, lang=None):
+        """
+        Return QueryMatcher of the global queries applicable with given flags.
+
+        Arguments:
+            flags       --- Scope flags.
+
+        Keyworded arguments:
+            lang        --- Language of the conversation (None for queries of all languages).
+
+        """
+        key = (frozenset(flags), lang)
+        matcher = self.matchers.get(key)
+        if matcher is None:
+            queries = []
+            for file_lang, items in self.languages:
+                if lang is None or file_lang is None or file_lang == lang:
+                    queries.extend(item for item in items if item["scope"] in key[0])
+            matcher = self.matchers[key] = QueryMatcher(queries)
+        return matcher
+
+    def get_response(self, state, state_others, query, flags=["chat"], lang=None):
         log.debug(_("Getting response for {!r}.").format(query))
-        queries = []
-        queries += filter(lambda i: i["scope"] in flags, state)
-        queries += filter(lambda i: i["scope"] in flags, state_others)
-        queries += filter(lambda i: i["scope"] in flags, self.queries)
-        log.debug(_("Got {} queries left from {}, {}, {}.").format(len(queries), len(state), len(state_others), len(self.queries)))
-
-        for item in queries:
-            if item["pattern"].search(query) is not None:
-                response = self._get_random_response(item["replies"], flags)
-                if response is None:
-                    continue
-
-                filters = response.get("filter", "common")
-                if filters != "common":
-                    filters = "{} common".format(filters)
-
-                log.debug("Got {!r}.".format(response["text"]))
-                return response["text"], response["queries"], filters.split(" ")
+        # Conversation state is short and changes on every response, check it query by query
+        for item in state + state_others:
+            if item["scope"] in flags and item["pattern"].search(query) is not None:
+                response = self._get_random_response(item, flags)
+                if response is not None:
+                    return self._format_response(response)
+
+        # Matching of the global queries doesn't depend on the state, the replies are still drawn at random
+        item = self._get_global_query(query, flags, lang)
+        if item is not None:
+            return self._format_response(self._get_random_response(item, flags))
 
         return None, None, None
 
-    def _get_random_response(self, choices, flags=["chat"]):
-        replies = []
-        replies += filter(lambda i: i["scope"] in flags, choices)
+    def _get_global_query(self, query, flags, lang):
+        """ Return the first global query matching the message and having some reply for the flags """
+        if len(self.langs) == 0:
+            # All queries are for all languages
+            lang = None
+        key = (query, frozenset(flags), lang)
+        if key in self.memo:
+            self.memo_hits += 1
+            self.memo.move_to_end(key)
+            return self.memo[key]
+        self.memo_misses += 1
+
+        matcher = self.get_matcher(key[1], lang)
+        found = None
+        for index in matcher.matches(query):
+            if len(self._get_replies_table(matcher.queries[index], key[1])[0]) > 0:
+                found = matcher.queries[index]
+                break
+        if self.memo_size > 0:
+            if len(self.memo) >= self.memo_size:
+                self.memo.popitem(last=False)
+            self.memo[key] = found
+        return found
+
+    def get_memo_stats(self):
+        """
+        Return number of hits, misses and entries of the memoized matching.
+
+        """
+        return self.memo_hits, self.memo_misses, len(self.memo)
+
+    def _format_response(self, response):
+        filters = response.get("filter", "common")
+        if filters != "common":
+            filters = "{} common".format(filters)
+
+        log.debug("Got {!r}.".format(response["text"]))
+        return response["text"], response["queries"], filters.split(" ")
+
+    def _get_random_response(self, query, flags=["chat"]):
+        replies, weights = self._get_replies_table(query, flags)
 
         if len(replies) == 0:
             return None
         elif len(replies) == 1:
             return replies[0]
 
-        sum_ = 0
-        for item in replies:
-            sum_ += item["weight"]
+        log.debug(_("Randomly choosing from {} choices (weight sum {}).").format(len(replies), weights[-1]))
 
-        log.debug(_("Randomly choosing from {} choices (weight sum {}).").format(len(replies), sum_))
-
-        select = random.randint(1, sum_)
-        sum_ = 0
-        for item in replies:
-            sum_ += item["weight"]
-            if select <= sum_:
-                return item
+        select = random.randint(1, weights[-1])
+        return replies[bisect.bisect_left(weights, select)]
 
 
 class Logger:
-    def __init__(self, path):
+    """
+    Conversation logger, one file per room (or private chat) and day.
+    Records are written by a background thread, the files are kept open (the least recently used ones are closed)
+    and flushed periodically.
+
+    Attributes:
+        path            --- Path to the log directory.
+        handles         --- Maximum number of open files.
+        flush_interval  --- Maximum number of seconds a record may stay in the buffers.
+        dropped         --- Number of records dropped because the queue was full.
+
+    Methods:
+        log             --- Queue the record about message and response.
+        shutdown        --- Write all queued records and close the files.
+
+    """
+
+    def __init__(self, path, handles=32, flush_interval=5, backlog=10000):
+        """
+        Arguments:
+            path            --- Path to the log directory.
+
+        Keyworded arguments:
+            handles         --- Maximum number of open files.
+            flush_interval  --- Maximum number of seconds a record may stay in the buffers.
+            backlog         --- Maximum number of queued records.
+
+        """
         self.path = path
+        self.handles = max(1, handles)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._records = queue.Queue(backlog)
+        # filename -> file, least recently used first
+        self._files = OrderedDict()
+        self._dirty = set()
+        self._thread = threading.Thread(target=self._loop, name="chatbot_logger")
+        self._thread.daemon = True
+        self._thread.start()
 
     def log(self, msg, response):
-        message = msg.get("body", "").replace("\n", "||")
+        """
+        Queue the record about message and response.
+
+        Arguments:
+            msg         --- Message stanza.
+            response    --- Response text (None if there's no response).
+
+        """
         if msg["type"] == "groupchat":
-            filename = "{}.log".format(msg["mucroom"])
-            message = "{}\t{}".format(msg["mucnick"], message)
+            record = (datetime.datetime.now(), msg["mucroom"], msg["mucnick"], msg.get("body", ""), response)
         else:
-            filename = "{}---{}.log".format(msg["from"].bare.replace("/", "-"), msg["from"].resource.replace("/", "-"))
-
+            name = "{}---{}".format(msg["from"].bare.replace("/", "-"), msg["from"].resource.replace("/", "-"))
+            record = (datetime.datetime.now(), name, None, msg.get("body", ""), response)
+        try:
+            self._records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def shutdown(self):
+        """
+        Write all queued records and close the files.
+
+        """
+        self._records.put(None)
+        self._thread.join()
+
+    def _loop(self):
+        last_flush = time.time()
+        while True:
+            try:
+                record = self._records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                self._write(*record)
+            if time.time() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.time()
+        for fp in self._files.values():
+            self._close(fp)
+        self._files.clear()
+        if self.dropped > 0:
+            log.warn(_("Conversation logger dropped {} records.").format(self.dropped))
+
+    def _write(self, now, name, nick, message, response):
+        message = message.replace("\n", "||")
+        if nick is not None:
+            message = "{}\t{}".format(nick, message)
         dnf = "OK"
         if response is None:
             dnf = "DNF"
         else:
             response = response.replace("\n", "||")
+        filename = "{}.{:%Y-%m-%d}.log".format(name, now)
+        text = "{:%Y-%m-%d %X}\t{}\t{}\n\t\t{}\n".format(now, dnf, message, response)
 
-        with open(os.path.join(self.path, filename), "a") as fp:
-            fp.write("{:%Y-%m-%d %X}\t{}\t{}\n\t\t{}\n".format(datetime.datetime.now(), dnf, message, response))
+        fp = self._files.pop(filename, None)
+        if fp is None:
+            if len(self._files) >= self.handles:
+                self._close(self._files.popitem(last=False)[1])
+            try:
+                fp = open(os.path.join(self.path, filename), "a")
+            except IOError:
+                log.exception(_("Could not open conversation log {}.").format(filename))
+                return
+        self._files[filename] = fp
+        try:
+            fp.write(text)
+            self._dirty.add(fp)
+        except IOError:
+            log.exception(_("Could not write conversation log {}.").format(filename))
+
+    def _flush(self):
+        for fp in self._dirty:
+            try:
+                fp.flush()
+            except IOError:
+                log.exception(_("Could not flush conversation log {}.").format(fp.name))
+        self._dirty.clear()
+        # Files of the previous days won't be written anymore
+        today = "{:%Y-%m-%d}.log".format(datetime.datetime.now())
+        for filename in [filename for filename in self._files if not filename.endswith(today)]:
+            self._close(self._files.pop(filename))
+
+    def _close(self, fp):
+        self._dirty.discard(fp)
+        try:
+            fp.close()
+        except IOError:
+            log.exception(_("Could not close conversation log {}.").format(fp.name))
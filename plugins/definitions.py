@@ -63,30 +63,30 @@ class definitions:
 
 
 class Storage:
+    migrations = (
+        """CREATE TABLE IF NOT EXISTS definitions (
+                        name VARCHAR(256) NOT NULL PRIMARY KEY,
+                        description VARCHAR(256) NOT NULL,
+                        level INT(4) NOT NULL)""",
+    )
+
     def __init__(self, store):
         self.store = store
         self.create_tables()
 
     def create_tables(self):
-        with self.store.lock:
-            self.store.query("""CREATE TABLE IF NOT EXISTS definitions (
-                            name VARCHAR(256) NOT NULL PRIMARY KEY,
-                            description VARCHAR(256) NOT NULL,
-                            level INT(4) NOT NULL)""")
+        self.store.migrate("definitions", self.migrations)
 
     def get(self, name):
-        with self.store.lock:
-            result = self.store.query("SELECT description, level FROM definitions WHERE name=?", (name.lower(),))
+        result = self.store.query("SELECT description, level FROM definitions WHERE name=?", (name.lower(),))
         if len(result) == 0:
             return None, 0
         return result[0]["description"], result[0]["level"]
 
     def update(self, name, description, level=0):
         log.debug(_("Updating definiton of {!r} with level {}.").format(name, level))
-        with self.store.lock:
-            self.store.query("INSERT OR REPLACE INTO definitions (name, description, level) VALUES(?,?,?)", (name.lower(), description, level))
+        self.store.query("INSERT OR REPLACE INTO definitions (name, description, level) VALUES(?,?,?)", (name.lower(), description, level))
 
     def delete(self, name):
         log.debug(_("Deleting definition of {!r}.").format(name))
-        with self.store.lock:
-            self.store.query("DELETE FROM definitions WHERE name=?", (name.lower(),))
+        self.store.query("DELETE FROM definitions WHERE name=?", (name.lower(),))
@@ -17,7 +17,6 @@ import queue
 import re
 import threading
 import time
-import urllib.request
 from xml.etree import cElementTree as ET
 
 log = logging.getLogger(__name__)
@@ -172,30 +171,32 @@ class feedreader:
 
 
 class Storage:
+    migrations = (
+        """CREATE TABLE IF NOT EXISTS feeds (
+                        feed VARCHAR(256) NOT NULL,
+                        item VARCHAR(256) NOT NULL,
+                        timestamp INT NOT NULL,
+                        PRIMARY KEY (feed, item))""",
+        "CREATE INDEX IF NOT EXISTS feeds_timestamp ON feeds (feed, timestamp)",
+    )
+
     def __init__(self, store):
         self.store = store
         self.create_tables()
 
     def create_tables(self):
-        with self.store.lock:
-            self.store.query("""CREATE TABLE IF NOT EXISTS feeds (
-                            feed VARCHAR(256) NOT NULL,
-                            item VARCHAR(256) NOT NULL,
-                            timestamp INT NOT NULL,
-                            PRIMARY KEY (feed, item))""")
+        self.store.migrate("feedreader", self.migrations)
 
     def add(self, feed, item):
         log.debug(_("Storing new item {} in feed {}.").format(item, feed))
-        with self.store.lock:
-            self.store.query("INSERT OR REPLACE INTO feeds (feed, item, timestamp) VALUES(?,?,?)", (feed, item, int(time.time())))
+        self.store.write("INSERT OR REPLACE INTO feeds (feed, item, timestamp) VALUES(?,?,?)", (feed, item, int(time.time())))
 
     def get(self, feed):
-        with self.store.lock:
-            for row in self.store.query("SELECT item FROM feeds WHERE feed=? ORDER BY timestamp DESC LIMIT 500, 10000", (feed,)):
-                self.store.query("DELETE FROM feeds WHERE feed=? AND item=?", (feed, row["item"]))
-            items = []
-            for row in self.store.query("SELECT item FROM feeds WHERE feed=?", (feed,)):
-                items.append(row["item"])
+        self.store.flush()
+        self.store.query("DELETE FROM feeds WHERE feed=? AND item IN (SELECT item FROM feeds WHERE feed=? ORDER BY timestamp DESC LIMIT -1 OFFSET 500)", (feed, feed))
+        items = []
+        for row in self.store.query("SELECT item FROM feeds WHERE feed=?", (feed,)):
+            items.append(row["item"])
         return items
 
 
@@ -210,6 +211,7 @@ class Parser:
 
     def check(self):
         try:
+            import urllib.request
             response = urllib.request.urlopen(self.url, timeout=10)
             response = re.sub("<content type=\"html\">.*?</content>", "", response.read().decode("utf-8"), 0, re.S)
             xml = ET.fromstring(response)
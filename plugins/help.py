@@ -22,42 +22,61 @@ class help:
         self.cmd_prefix = bot.cmd_prefix
         self.bot_commands = bot.commands
         self.get_command_level = bot.get_command_level
+        self.get_registry_version = bot.get_registry_version
         self.help_topics = bot.help_topics
         self.gettext = bot.gettext
         self.ngettext = bot.ngettext
+        self.cache = {}
+        self.cache_version = None
 
         bot.add_command("help", self.help, __("Help"), __("If no topic was given, display the list of available commands and other help topics. Otherwise display the help for a given topic."), __("[command/topic]"))
         bot.add_command("commands", self.commands, __("Commands"), __("Display list of available commands."))
 
+    def _get_cache(self):
+        """ Return the cache of rendered help, drop it if the registry has changed """
+        version = self.get_registry_version()
+        if version != self.cache_version:
+            self.cache = {}
+            self.cache_version = version
+        return self.cache
+
     def commands(self, command, args, msg, uc):
-        response = self.gettext("Available commands", uc.lang) + ":\n"
-        for cmd in sorted(self.bot_commands.keys()):
-            if self.get_command_level(cmd) > uc.level:
-                continue
-            response += self.cmd_prefix + cmd
-            if self.help_topics[cmd].title is not None:
-                response += " -- " + self.gettext(self.help_topics[cmd].title, uc.lang)
-            response += "\n"
-        response = response.strip("\n")
-        return response
+        cache = self._get_cache()
+        key = ("commands", uc.lang, uc.level)
+        if key not in cache:
+            lines = [self.gettext("Available commands", uc.lang) + ":"]
+            for cmd in sorted(self.bot_commands.keys()):
+                if self.get_command_level(cmd) > uc.level:
+                    continue
+                line = self.cmd_prefix + cmd
+                if self.help_topics[cmd].title is not None:
+                    line += " -- " + self.gettext(self.help_topics[cmd].title, uc.lang)
+                lines.append(line)
+            cache[key] = "\n".join(lines).strip("\n")
+        return cache[key]
 
     def help(self, command, args, msg, uc):
-        response = ""
+        cache = self._get_cache()
+        prefix = ""
         if len(args) == 0:
-            response += self.commands(command, args, msg, uc) + "\n"
-            start = True
-            for topic in sorted(self.help_topics.keys()):
-                if topic in self.bot_commands:
-                    continue
-                if start:
-                    response += "\n" + self.gettext("Other available help topics", uc.lang) + ":\n"
-                    start = False
-                response += topic
-                if self.help_topics[topic].title is not None:
-                    response += " -- " + self.gettext(self.help_topics[topic].title, uc.lang)
-                response += "\n"
+            key = ("help", uc.lang, uc.level)
+            if key not in cache:
+                lines = [self.commands(command, args, msg, uc)]
+                start = True
+                for topic in sorted(self.help_topics.keys()):
+                    if topic in self.bot_commands:
+                        continue
+                    if start:
+                        lines.append("\n" + self.gettext("Other available help topics", uc.lang) + ":")
+                        start = False
+                    line = topic
+                    if self.help_topics[topic].title is not None:
+                        line += " -- " + self.gettext(self.help_topics[topic].title, uc.lang)
+                    lines.append(line)
+                lines.append("---------\n")
+                cache[key] = "\n".join(lines)
+            prefix = cache[key]
             args = "help"
-            response += "---------\n"
 
         if args.startswith(self.cmd_prefix) and len(args) > len(self.cmd_prefix):
             args = args[len(self.cmd_prefix):]
@@ -65,15 +84,18 @@ class help:
         if args not in self.help_topics or (args in self.bot_commands and uc.level < self.get_command_level(args)):
             return self.gettext("Don't know...", uc.lang)
 
-        help_topic = self.help_topics[args]
-        if help_topic.title is not None:
-            response += self.gettext(help_topic.title, uc.lang) + "\n"
-        if help_topic.body is not None:
-            body = help_topic.body
-            if isinstance(body, str):
-                body = [body]
-            for part in body:
-                response += self.gettext(part, uc.lang)
-        response = response.strip("\n")
-
-        return response
+        key = ("topic", uc.lang, args)
+        if key not in cache:
+            parts = []
+            help_topic = self.help_topics[args]
+            if help_topic.title is not None:
+                parts.append(self.gettext(help_topic.title, uc.lang) + "\n")
+            if help_topic.body is not None:
+                body = help_topic.body
+                if isinstance(body, str):
+                    body = [body]
+                for part in body:
+                    parts.append(self.gettext(part, uc.lang))
+            cache[key] = "".join(parts)
+
+        return (prefix + cache[key]).strip("\n")
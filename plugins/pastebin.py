@@ -12,8 +12,6 @@ __version__ = "0.5.0"
 
 
 import logging
-import urllib.parse
-import urllib.request
 
 log = logging.getLogger(__name__)
 __ = lambda x: x # Fake gettext function
@@ -67,6 +65,8 @@ class pastebin:
         log.debug(data)
 
         try:
+            import urllib.parse
+            import urllib.request
             data = urllib.parse.urlencode(data).encode("utf-8")
             response = urllib.request.urlopen("http://pastebin.com/api_public.php", data, 10).read().decode("utf-8")
             url = str(response.split("\n", 1)[0])
@@ -12,22 +12,51 @@ __license__ = "GPL 3.0"
 __version__ = "0.5.0"
 
 
+from collections import OrderedDict
 import logging
+import threading
 import time
+import unicodedata
 
 log = logging.getLogger(__name__)
 __ = lambda x: x # Fake gettext function
 
 
+def normalize(nick):
+    """ Case-fold the nick and strip diacritics and non-alphanumeric characters """
+    nick = unicodedata.normalize("NFKD", nick.casefold() if hasattr(nick, "casefold") else nick.lower())
+    return "".join(char for char in nick if char.isalnum())
+
+
+def trigrams(normalized):
+    """ Return set of trigrams of the normalized nick """
+    padded = "  {} ".format(normalized)
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+
+def edit_distance(first, second):
+    """ Levenshtein distance of two strings """
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
 class seen:
     sleek_plugins = ("xep_0045",)
 
     def __init__(self, bot, config):
         self.gettext = bot.gettext
         self.ngettext = bot.ngettext
-        self.store = Storage(bot.store)
+        config = config.get("config", {})
+        self.store = Storage(bot.store, float(config.get("flush", 10)), int(config.get("cache", 10000)), float(config.get("retention", 0)))
 
-        bot.add_command("seen", self.seen, __("User last seen"), __("Display the last sighting of the user in MUC room."), __("nick"))
+        bot.add_command("seen", self.seen, __("User last seen"), __("Display the last sighting of the user in MUC room. If the nick is unknown in the room, similar nicks are searched in all rooms."), __("nick"))
         bot.add_event_handler("got_online", self.handle_got_online, threaded=True) # Unfortunately we're double-logging a bit here
         bot.add_event_handler("groupchat_presence", self.handle_presence, threaded=True)
         bot.add_event_handler("groupchat_message", self.handle_message, threaded=True)
@@ -36,6 +65,7 @@ class seen:
         bot.del_event_handler("got_online", self.handle_got_online)
         bot.del_event_handler("groupchat_presence", self.handle_presence)
         bot.del_event_handler("groupchat_message", self.handle_message)
+        self.store.shutdown()
 
     def handle_got_online(self, pr):
         if "muc" not in pr.keys() or pr["type"] in ("error", "probe"):
@@ -67,11 +97,17 @@ class seen:
                 return self.gettext("{} idles in the room for {}.", uc.lang).format(args, delta)
         else:
             seen = self.store.get(room, args)
-            if seen is None:
-                return self.gettext("{}? I have no idea about whom you're talking...", uc.lang).format(args)
-            else:
+            if seen is not None:
                 delta = self.format_timedelta(time.time() - seen[0], uc.lang)
                 return self.gettext("It's {} since I last saw {} in the room.", uc.lang).format(delta, args)
+            found = self.store.search(args, self.xep_0045.getJoinedRooms())
+            if len(found) == 0:
+                return self.gettext("{}? I have no idea about whom you're talking...", uc.lang).format(args)
+            lines = [self.gettext("I don't know {} here, but I've seen:", uc.lang).format(args)]
+            for found_room, nick, seen in found:
+                delta = self.format_timedelta(time.time() - seen[0], uc.lang)
+                lines.append(self.gettext("{} in {} {} ago", uc.lang).format(nick, found_room, delta))
+            return "\n".join(lines)
 
     def format_timedelta(self, delta, lang):
         parts = []
@@ -108,40 +144,223 @@ class seen:
 
 
 class Storage:
+    """
+    Storage of user sightings.
+    The latest records are kept in memory and serve the queries directly, dirty records are periodically
+    written to the database in a single transaction, so repeated updates of the same record collapse into one write.
+    Records older than retention days are deleted by the flush thread, so that they don't linger in the cache.
+
+    """
+
     events = ("message", "got_online", "got_offline", "presence")
+    migrations = (
+        """CREATE TABLE IF NOT EXISTS seen (
+                        room VARCHAR(256) NOT NULL,
+                        nick VARCHAR(256) NOT NULL,
+                        event INTEGER(1) NOT NULL,
+                        timestamp INT NOT NULL,
+                        text VARCHAR(256),
+                        PRIMARY KEY (room, nick, event))""",
+        "CREATE INDEX IF NOT EXISTS seen_timestamp ON seen (room, nick, timestamp)",
+        ("""CREATE TABLE IF NOT EXISTS seen_nicks (
+                        room VARCHAR(256) NOT NULL,
+                        nick VARCHAR(256) NOT NULL,
+                        normalized VARCHAR(256) NOT NULL,
+                        PRIMARY KEY (room, nick))""",
+         "CREATE INDEX IF NOT EXISTS seen_nicks_normalized ON seen_nicks (normalized)",
+         """CREATE TABLE IF NOT EXISTS seen_trigrams (
+                        trigram VARCHAR(3) NOT NULL,
+                        normalized VARCHAR(256) NOT NULL,
+                        PRIMARY KEY (trigram, normalized))"""),
+        # Keep the search index in sync with deletions (retention) of the seen records
+        ("CREATE INDEX IF NOT EXISTS seen_trigrams_normalized ON seen_trigrams (normalized)",
+         """CREATE TRIGGER IF NOT EXISTS seen_unindex AFTER DELETE ON seen
+                WHEN NOT EXISTS (SELECT 1 FROM seen WHERE room=OLD.room AND nick=OLD.nick)
+                BEGIN
+                    DELETE FROM seen_trigrams WHERE normalized=(SELECT normalized FROM seen_nicks WHERE room=OLD.room AND nick=OLD.nick)
+                        AND NOT EXISTS (SELECT 1 FROM seen_nicks WHERE normalized=seen_trigrams.normalized AND (room!=OLD.room OR nick!=OLD.nick));
+                    DELETE FROM seen_nicks WHERE room=OLD.room AND nick=OLD.nick;
+                END""",
+         "DELETE FROM seen_nicks WHERE NOT EXISTS (SELECT 1 FROM seen WHERE seen.room=seen_nicks.room AND seen.nick=seen_nicks.nick)",
+         "DELETE FROM seen_trigrams WHERE NOT EXISTS (SELECT 1 FROM seen_nicks WHERE seen_nicks.normalized=seen_trigrams.normalized)"),
+    )
+    candidates = 50
+    retention_interval = 3600
+    retention_batch = 1000
 
-    def __init__(self, store):
+    def __init__(self, store, interval=10, size=10000, retention=0):
         self.store = store
+        self.interval = interval
+        self.size = max(1, size)
+        self.retention = retention
+        self.last_retention = 0
+        # (room, nick) -> {event: (timestamp, text)}, complete records loaded from the database
+        self.cache = OrderedDict()
+        # (room, nick, event) -> (timestamp, text), records not yet written to the database
+        self.dirty = {}
+        self.lock = threading.Lock()
+        # Serializes flushes with loading of records from the database
+        self.flush_lock = threading.Lock()
         self.create_tables()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.flush_loop, name="seen_flush")
+        self.thread.daemon = True
+        self.thread.start()
 
     def create_tables(self):
-        with self.store.lock:
-            self.store.query("""CREATE TABLE IF NOT EXISTS seen (
-                            room VARCHAR(256) NOT NULL,
-                            nick VARCHAR(256) NOT NULL,
-                            event INTEGER(1) NOT NULL,
-                            timestamp INT NOT NULL,
-                            text VARCHAR(256),
-                            PRIMARY KEY (room, nick, event))""")
+        self.store.migrate("seen", self.migrations)
+        # Index nicks recorded before the index existed
+        with self.store.transaction() as db:
+            keys = db.execute("SELECT DISTINCT room, nick FROM seen WHERE NOT EXISTS (SELECT 1 FROM seen_nicks WHERE seen_nicks.room=seen.room AND seen_nicks.nick=seen.nick)").fetchall()
+            if len(keys) > 0:
+                log.info(_("Indexing {} seen nicks.").format(len(keys)))
+                self.index_nicks(db, keys)
+
+    @staticmethod
+    def index_nicks(db, keys):
+        """ Add (room, nick) pairs to the search index """
+        for room, nick in keys:
+            normalized = normalize(nick)
+            if db.execute("INSERT OR IGNORE INTO seen_nicks (room, nick, normalized) VALUES(?,?,?)", (room, nick, normalized)).rowcount > 0:
+                db.executemany("INSERT OR IGNORE INTO seen_trigrams (trigram, normalized) VALUES(?,?)", [(trigram, normalized) for trigram in trigrams(normalized)])
+
+    def shutdown(self):
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+
+    def flush_loop(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+            if self.retention > 0 and time.time() - self.last_retention >= self.retention_interval:
+                self.expire()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                dirty = self.dirty
+                self.dirty = {}
+            if len(dirty) == 0:
+                return
+            log.debug(_("Writing {} seen records.").format(len(dirty)))
+            try:
+                with self.store.transaction() as db:
+                    db.executemany("INSERT OR REPLACE INTO seen (room, nick, event, timestamp, text) VALUES(?,?,?,?,?)", [key + value for key, value in dirty.items()])
+                    self.index_nicks(db, set(key[:2] for key in dirty))
+            except:
+                log.exception(_("Writing of seen records FAILED."))
+                with self.lock:
+                    for key, value in dirty.items():
+                        self.dirty.setdefault(key, value)
+
+    def expire(self):
+        """ Delete records older than the retention period from the database and from memory """
+        self.last_retention = time.time()
+        limit = int(self.last_retention - self.retention * 86400)
+        deleted = 0
+        try:
+            while not self.stop.is_set():
+                with self.store.transaction() as db:
+                    count = db.execute("DELETE FROM seen WHERE rowid IN (SELECT rowid FROM seen WHERE timestamp<? LIMIT ?)", (limit, self.retention_batch)).rowcount
+                deleted += count
+                if count < self.retention_batch:
+                    break
+        except:
+            log.exception(_("Deleting of old seen records FAILED."))
+        # Records loaded before the deletion must not be served (or written back) from memory
+        with self.flush_lock:
+            with self.lock:
+                for key, record in list(self.dirty.items()):
+                    if record[0] < limit:
+                        del self.dirty[key]
+                for key, records in list(self.cache.items()):
+                    for event, record in list(records.items()):
+                        if record[0] < limit:
+                            del records[event]
+                    if len(records) == 0:
+                        del self.cache[key]
+        if deleted > 0:
+            log.info(_("Deleted {} old seen records.").format(deleted))
 
     def update(self, room, nick, event, text=None):
         event = self.events.index(event)
         log.debug(_("Updating seen record for {!r} in {}.").format(nick, room))
-        with self.store.lock:
-            self.store.query("INSERT OR REPLACE INTO seen (room, nick, event, timestamp, text) VALUES(?,?,?,?,?)", (room, nick, event, int(time.time()), text))
+        record = (int(time.time()), text)
+        with self.lock:
+            self.dirty[(room, nick, event)] = record
+            if (room, nick) in self.cache:
+                self.cache[(room, nick)][event] = record
 
-    def get(self, room, nick):
-        with self.store.lock:
-            result = self.store.query("SELECT event, timestamp, text FROM seen WHERE room=? AND nick=? ORDER BY timestamp DESC LIMIT 1", (room, nick))
-        if len(result) == 0:
-            return None
-        result = result[0]
-        return (int(result["timestamp"]), result["text"], self.events[int(result["event"])])
+    def get_records(self, room, nick):
+        """ Return dictionary event -> (timestamp, text) of the user """
+        with self.lock:
+            records = self.cache.get((room, nick))
+            if records is not None:
+                self.cache.move_to_end((room, nick))
+                return dict(records)
+        records = {}
+        with self.flush_lock:
+            for row in self.store.query("SELECT event, timestamp, text FROM seen WHERE room=? AND nick=?", (room, nick)):
+                records[int(row["event"])] = (int(row["timestamp"]), row["text"])
+            with self.lock:
+                for event in range(len(self.events)):
+                    record = self.dirty.get((room, nick, event))
+                    if record is not None:
+                        records[event] = record
+                self.cache[(room, nick)] = records
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+                return dict(records)
+
+    def get(self, room, nick, events=None):
+        records = self.get_records(room, nick)
+        result = None
+        for event, (timestamp, text) in records.items():
+            if events is not None and self.events[event] not in events:
+                continue
+            if result is None or timestamp > result[0]:
+                result = (timestamp, text, self.events[event])
+        return result
 
     def getActivity(self, room, nick):
-        with self.store.lock:
-            result = self.store.query("SELECT event, timestamp, text FROM seen WHERE room=? AND nick=? AND (event=? OR event=?) ORDER BY timestamp DESC LIMIT 1", (room, nick, self.events.index("message"), self.events.index("got_online")))
-        if len(result) == 0:
-            return None
-        result = result[0]
-        return (int(result["timestamp"]), result["text"], self.events[int(result["event"])])
+        return self.get(room, nick, ("message", "got_online"))
+
+    def search(self, nick, rooms=None, limit=3):
+        """
+        Search for sightings of nicks similar to the given one (case and diacritic insensitive).
+        Returns list of (room, nick, (timestamp, text, event)), the most similar and recent first.
+
+        """
+        normalized = normalize(nick)
+        if len(normalized) == 0:
+            return []
+        grams = tuple(trigrams(normalized))
+        rows = self.store.query("SELECT normalized FROM seen_trigrams WHERE trigram IN ({}) GROUP BY normalized ORDER BY COUNT(*) DESC LIMIT ?".format(",".join("?" * len(grams))), grams + (self.candidates,))
+        candidates = set(row["normalized"] for row in rows)
+        with self.lock:
+            # Nicks not indexed yet
+            unindexed = set(key[:2] for key in self.dirty)
+        candidates.update(normalize(key[1]) for key in unindexed)
+
+        threshold = max(1, len(normalized) // 3)
+        distances = {}
+        for candidate in candidates:
+            distance = edit_distance(normalized, candidate)
+            if distance <= threshold:
+                distances[candidate] = distance
+        if len(distances) == 0:
+            return []
+
+        keys = set(key for key in unindexed if normalize(key[1]) in distances)
+        matched = tuple(distances.keys())
+        for row in self.store.query("SELECT room, nick FROM seen_nicks WHERE normalized IN ({})".format(",".join("?" * len(matched))), matched):
+            keys.add((row["room"], row["nick"]))
+        found = []
+        for room, found_nick in keys:
+            if rooms is not None and room not in rooms:
+                continue
+            seen = self.get(room, found_nick)
+            if seen is not None:
+                found.append((distances[normalize(found_nick)], -seen[0], room, found_nick, seen))
+        found.sort()
+        return [item[2:] for item in found[:limit]]
@@ -14,7 +14,7 @@ __version__ = "0.5.0"
 from html.parser import HTMLParser
 import logging
 import re
-from twython import Twython
+import threading
 
 log = logging.getLogger(__name__)
 __ = lambda x: x # Fake gettext function
@@ -23,12 +23,12 @@ __ = lambda x: x # Fake gettext function
 class twitter:
     _unescape = HTMLParser().unescape
     rooms = []
+    twython = None
 
     def __init__(self, bot, config):
         self.get_our_nick = bot.get_our_nick
-
-        auth = config.get("auth", [{}])[0]
-        self.twython = Twython(auth.get("app_key"), access_token=auth.get("access_token"))
+        self.lock = threading.Lock()
+        self.auth = config.get("auth", [{}])[0]
 
         for muc in config.get("muc", []):
             room = muc.get("room")
@@ -42,6 +42,14 @@ class twitter:
         for room in self.rooms:
             bot.del_event_handler("muc::{}::message".format(room), self.handle_message)
 
+    def get_twython(self):
+        """ Return Twython instance, twython (and requests) are imported on the first use """
+        with self.lock:
+            if self.twython is None:
+                from twython import Twython
+                self.twython = Twython(self.auth.get("app_key"), access_token=self.auth.get("access_token"))
+        return self.twython
+
     def handle_message(self, msg):
         if msg["mucnick"] in ("", self.get_our_nick(msg["mucroom"])):
             # Ignore system and own message in MUC
@@ -54,7 +62,7 @@ class twitter:
 
         status_id = match.group(2)
         try:
-            status = self.twython.show_status(id=status_id)
+            status = self.get_twython().show_status(id=status_id)
             name = self._unescape(status["user"]["screen_name"])
             status = self._unescape(status["text"])
         except:
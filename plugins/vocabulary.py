@@ -213,37 +213,37 @@ class vocabulary:
 
 
 class Storage:
+    migrations = (
+        ("""CREATE TABLE IF NOT EXISTS dictionaries (
+                         left VARCHAR(15) NOT NULL,
+                         right VARCHAR(15) NOT NULL,
+                         PRIMARY KEY (left, right))""",
+         """CREATE TABLE IF NOT EXISTS vocabulary (
+                         dictionary_id INTEGER NOT NULL,
+                         left_phrase VARCHAR(100) NOT NULL,
+                         left_note VARCHAR(255),
+                         right_phrase VARCHAR(100) NOT NULL,
+                         right_note VARCHAR(255),
+                         PRIMARY KEY (dictionary_id, left_phrase, right_phrase))""",
+         """CREATE TABLE IF NOT EXISTS vocabulary_weights (
+                         jid VARCHAR(100) NOT NULL,
+                         vocabulary_id INTEGER NOT NULL,
+                         left INT(1) NOT NULL DEFAULT 5,
+                         right INT(1) NOT NULL DEFAULT 5,
+                         PRIMARY KEY (jid, vocabulary_id))"""),
+    )
+
     def __init__(self, store):
         self.store = store
         self.create_tables()
 
     def create_tables(self):
-        with self.store.lock:
-            self.store.query("""CREATE TABLE IF NOT EXISTS dictionaries (
-                            left VARCHAR(15) NOT NULL,
-                            right VARCHAR(15) NOT NULL,
-                            PRIMARY KEY (left, right))""")
-
-            self.store.query("""CREATE TABLE IF NOT EXISTS vocabulary (
-                            dictionary_id INTEGER NOT NULL,
-                            left_phrase VARCHAR(100) NOT NULL,
-                            left_note VARCHAR(255),
-                            right_phrase VARCHAR(100) NOT NULL,
-                            right_note VARCHAR(255),
-                            PRIMARY KEY (dictionary_id, left_phrase, right_phrase))""")
-
-            self.store.query("""CREATE TABLE IF NOT EXISTS vocabulary_weights (
-                            jid VARCHAR(100) NOT NULL,
-                            vocabulary_id INTEGER NOT NULL,
-                            left INT(1) NOT NULL DEFAULT 5,
-                            right INT(1) NOT NULL DEFAULT 5,
-                            PRIMARY KEY (jid, vocabulary_id))""")
+        self.store.migrate("vocabulary", self.migrations)
 
     def find_dictionary(self, left, right):
         left = left.strip().lower()
         right = right.strip().lower()
-        with self.store.lock:
-            result = self.store.query("SELECT [rowid], [left]=? AS [reverse] FROM [dictionaries] WHERE ([left]=? AND [right]=?) OR ([right]=? AND [left]=?)", (right, left, right, left, right))
+        result = self.store.query("SELECT [rowid], [left]=? AS [reverse] FROM [dictionaries] WHERE ([left]=? AND [right]=?) OR ([right]=? AND [left]=?)", (right, left, right, left, right))
         if (len(result) == 0):
             return None
         else:
@@ -252,14 +252,12 @@ class Storage:
     def create_dictionary(self, left, right):
         left = left.strip().lower()
         right = right.strip().lower()
-        with self.store.lock:
-            self.store.query("INSERT INTO dictionaries ([left], [right]) VALUES(?,?)", (left, right))
+        self.store.query("INSERT INTO dictionaries ([left], [right]) VALUES(?,?)", (left, right))
 
     def list_dictionary(self):
         dictionaries = []
-        with self.store.lock:
-            for row in self.store.query("SELECT [left], [right] FROM [dictionaries]"):
-                dictionaries.append((row["left"], row["right"]))
+        for row in self.store.query("SELECT [left], [right] FROM [dictionaries]"):
+            dictionaries.append((row["left"], row["right"]))
         return dictionaries
 
     def update_vocabulary(self, dictionary, left_phrase, right_phrase, left_note, right_note):
@@ -267,21 +265,18 @@ class Storage:
             left_note = None
         if right_note is not None and len(right_note) == 0:
             right_note = None
-        with self.store.lock:
-            self.store.query("INSERT OR REPLACE INTO [vocabulary] ([dictionary_id], [left_phrase], [right_phrase], [left_note], [right_note]) VALUES(?,?,?,?,?)", (dictionary, left_phrase, right_phrase, left_note, right_note))
+        self.store.query("INSERT OR REPLACE INTO [vocabulary] ([dictionary_id], [left_phrase], [right_phrase], [left_note], [right_note]) VALUES(?,?,?,?,?)", (dictionary, left_phrase, right_phrase, left_note, right_note))
 
     def delete_vocabulary(self, dictionary, left_phrase, right_phrase):
-        with self.store.lock:
-            self.store.query("DELETE FROM [vocabulary] WHERE [dictionary_id]=? AND [left_phrase]=? AND [right_phrase]=?", (dictionary, left_phrase, right_phrase))
+        self.store.query("DELETE FROM [vocabulary] WHERE [dictionary_id]=? AND [left_phrase]=? AND [right_phrase]=?", (dictionary, left_phrase, right_phrase))
 
     def list_vocabulary(self, dictionary, reverse):
         vocabulary = []
-        with self.store.lock:
-            for row in self.store.query("SELECT [left_phrase], [right_phrase], [left_note], [right_note] FROM [vocabulary] WHERE [dictionary_id]=?", (dictionary,)):
-                if reverse:
-                    vocabulary.append((row["right_phrase"], row["left_phrase"], row["right_note"], row["left_note"]))
-                else:
-                    vocabulary.append((row["left_phrase"], row["right_phrase"], row["left_note"], row["right_note"]))
+        for row in self.store.query("SELECT [left_phrase], [right_phrase], [left_note], [right_note] FROM [vocabulary] WHERE [dictionary_id]=?", (dictionary,)):
+            if reverse:
+                vocabulary.append((row["right_phrase"], row["left_phrase"], row["right_note"], row["left_note"]))
+            else:
+                vocabulary.append((row["left_phrase"], row["right_phrase"], row["left_note"], row["right_note"]))
         return vocabulary
 
     def get_vocabulary(self, dictionary, reverse, jid):
@@ -292,13 +287,12 @@ class Storage:
             side_query = "left"
             side_answer = "right"
         vocabulary = []
-        with self.store.lock:
-            db = self.store.get_db()
+        with self.store.connection() as db:
             for row in db.cursor().execute("SELECT [rowid], [left_phrase], [right_phrase], [left_note], [right_note] FROM [vocabulary] WHERE [dictionary_id]=?", (dictionary,)).fetchall():
                 phrase = {"id":row["rowid"]}
                 weight = db.cursor().execute("SELECT [{}] FROM [vocabulary_weights] WHERE jid=? AND vocabulary_id=?".format(side_query), (jid, row["rowid"])).fetchone()
                 if weight is not None:
-                    phrase["weight"] = int(weight[side])
+                    phrase["weight"] = int(weight[side_query])
                 else:
                     phrase["weight"] = 5
                 if row[side_query+"_note"] is not None:
@@ -307,12 +301,10 @@ class Storage:
                     phrase["query"] = row[side_query+"_phrase"]
                 phrase["answer"] = row[side_answer+"_phrase"]
                 vocabulary.append(phrase)
-            db.close()
         return vocabulary
 
     def set_weight(self, reverse, jid, phrase):
-        with self.store.lock:
-            if reverse:
-                self.store.query("INSERT OR REPLACE INTO [vocabulary_weights] (jid, vocabulary_id, right) VALUES(?,?,?)", (jid, phrase["id"], phrase["weight"]))
-            else:
-                self.store.query("INSERT OR REPLACE INTO [vocabulary_weights] (jid, vocabulary_id, left) VALUES(?,?,?)", (jid, phrase["id"], phrase["weight"]))
+        if reverse:
+            self.store.query("INSERT OR REPLACE INTO [vocabulary_weights] (jid, vocabulary_id, right) VALUES(?,?,?)", (jid, phrase["id"], phrase["weight"]))
+        else:
+            self.store.query("INSERT OR REPLACE INTO [vocabulary_weights] (jid, vocabulary_id, left) VALUES(?,?,?)", (jid, phrase["id"], phrase["weight"]))
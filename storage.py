@@ -4,6 +4,7 @@ Module for accessing persistent sqlite3 storage.
 
 Classes:
     Storage     --- Sqlite3 database storage.
+    QueryStats  --- Statistics of a normalized SQL statement.
 
 """
 
@@ -13,47 +14,377 @@ __copyright__ = ["Copyright (C) 2008 Kevin Smith",
 __license__ = "GPL 3.0"
 __version__ = "0.5.0"
 
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import itertools
+import logging
+import queue
+import re
 import sqlite3
+import sys
 import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """
+    Statistics of a normalized SQL statement issued by a module.
+
+    Attributes:
+        source      --- Name of the module issuing the statement.
+        query       --- Normalized SQL statement.
+        count       --- Number of executions.
+        total       --- Total execution time in seconds (including fetch).
+        max         --- Maximum execution time in seconds.
+        wait        --- Total time in seconds the statement waited in the worker queue.
+        rows        --- Total number of fetched or modified rows.
+
+    """
+
+    __slots__ = ("source", "query", "count", "total", "max", "wait", "rows")
+
+    def __init__(self, source, query):
+        self.source = source
+        self.query = query
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.wait = 0.0
+        self.rows = 0
+
+
+class _Cursor(sqlite3.Cursor):
+    """ Cursor recording statistics of executed statements """
+
+    def execute(self, query, values=()):
+        storage = self.connection.storage
+        start = time.time()
+        result = super().execute(query, values)
+        elapsed = time.time() - start
+        self._stats = storage._record(query, elapsed, max(0, self.rowcount))
+        if elapsed >= storage.slow_query > 0:
+            try:
+                plan = [row[-1] for row in sqlite3.Cursor(self.connection).execute("EXPLAIN QUERY PLAN " + query, values)]
+            except sqlite3.Error:
+                plan = []
+            log.warn("\n".join([_("Slow query ({:.3f} s) from {}: {}").format(elapsed, self._stats.source, query)] + plan))
+        return result
+
+    def executemany(self, query, seq):
+        storage = self.connection.storage
+        start = time.time()
+        result = super().executemany(query, seq)
+        elapsed = time.time() - start
+        self._stats = storage._record(query, elapsed, max(0, self.rowcount))
+        if elapsed >= storage.slow_query > 0:
+            log.warn(_("Slow query ({:.3f} s) from {}: {}").format(elapsed, self._stats.source, query))
+        return result
+
+    def fetchone(self):
+        start = time.time()
+        row = super().fetchone()
+        self._fetched(time.time() - start, 0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        start = time.time()
+        rows = super().fetchall()
+        self._fetched(time.time() - start, len(rows))
+        return rows
+
+    def _fetched(self, elapsed, rows):
+        stats = getattr(self, "_stats", None)
+        if stats is not None:
+            stats.total += elapsed
+            stats.rows += rows
+
+
+class _Connection(sqlite3.Connection):
+    """ Connection using instrumented cursors """
+
+    storage = None
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def execute(self, query, values=()):
+        return self.cursor().execute(query, values)
+
+    def executemany(self, query, seq):
+        return self.cursor().executemany(query, seq)
 
 
 class Storage:
     """
     Sqlite3 database storage.
 
+    Writes are serialized in the database worker thread (sqlite3 allows only one writer anyway).
+    Queries somebody waits for skip the queued background writes, unless the caller has queued writes itself.
+    Reads run concurrently on pooled connections and see the last commited snapshot (WAL),
+    they go through the worker thread only if the calling thread has uncommited queued writes.
+
+    Attributes:
+        filename        --- Path to sqlite3 file.
+        synchronous     --- Value of sqlite3 synchronous pragma.
+        delay           --- Maximum number of seconds a write may wait in the write-behind queue.
+        batch           --- Maximum number of writes commited in a single transaction.
+        backlog         --- Maximum number of queued jobs, write blocks when the queue is full.
+        slow_query      --- Statements running longer than this number of seconds are logged with their plan (0 disables).
+
     Methods:
-        get_db  --- Get database connection instance.
-        query   --- Return ANSI code for changing terminal title.
+        get_db          --- Get new database connection instance.
+        connection      --- Context manager borrowing a pooled database connection.
+        transaction     --- Context manager borrowing a pooled database connection for direct writes.
+        query           --- Perform query in current database and return the result.
+        submit          --- Submit query and return Future.
+        write           --- Queue a write query to be commited in the background.
+        flush           --- Wait until all queued writes are commited.
+        get_lock        --- Get lock for serializing multi-statement operations of the plugin.
+        migrate         --- Upgrade schema of the plugin to the latest version.
+        explain         --- Return query plan of the query.
+        idle_time       --- Return number of seconds since the last write, 0 if there are uncommited writes.
+        get_stats       --- Return statistics of the executed statements.
+        reset_stats     --- Forget statistics of the executed statements.
+        close           --- Close all pooled connections.
+        shutdown        --- Commit queued writes, stop the writer thread and close connections.
 
     """
 
-    lock = threading.RLock()
+    lock = threading.RLock() # Deprecated, use get_lock
+    _URGENT, _NORMAL, _LAST = range(3)
+    pool_size = 8
+    cached_statements = 100
+    slow_query = 0.5
+    _max_normalized = 1000
+    _normalize_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
 
-    def __init__(self, filename):
+    def __init__(self, filename, synchronous="NORMAL", delay=0.5, batch=100, backlog=1000):
         """
         Arguments:
             filename    --- Path to sqlite3 file.
 
+        Keyworded arguments:
+            synchronous --- Value of sqlite3 synchronous pragma (OFF, NORMAL, FULL).
+            delay       --- Maximum number of seconds a write may wait in the write-behind queue.
+            batch       --- Maximum number of writes commited in a single transaction.
+            backlog     --- Maximum number of queued jobs, write blocks when the queue is full
+                            (queries waited for by threads without queued writes are not limited).
+
         """
-        self._filename = filename
+        self.filename = filename
+        self.synchronous = synchronous
+        self.delay = delay
+        self.batch = max(1, batch)
+        self.backlog = max(self.batch, backlog)
+        self._pool = queue.LifoQueue(self.pool_size)
+        # Entries (priority, sequence number, job), see _put
+        self._jobs = queue.PriorityQueue()
+        self._backlog = threading.Semaphore(self.backlog)
+        self._sequence = itertools.count()
+        self._pending = {}
+        self._last_put = time.time()
+        self._transactions = 0
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._readers = None
+        self._migration_lock = threading.Lock()
+        self._locks = {}
+        self._context = threading.local()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._normalized = {}
 
 
     def get_db(self, timeout=30):
         """
-        Get database connection instance.
+        Get new database connection instance.
+        The caller is responsible for closing the connection.
 
         Keyworded arguments:
             timeout         --- Number of seconds to wait for database to release lock.
 
         """
-        con = sqlite3.connect(self._filename, timeout)
+        con = sqlite3.connect(self.filename, timeout, check_same_thread=False, cached_statements=self.cached_statements, factory=_Connection)
+        con.storage = self
         con.row_factory = sqlite3.Row
+        sqlite3.Connection.execute(con, "PRAGMA journal_mode=WAL")
+        sqlite3.Connection.execute(con, "PRAGMA synchronous={}".format(self.synchronous))
         return con
 
 
+    @contextmanager
+    def connection(self):
+        """
+        Context manager borrowing a pooled database connection.
+        The transaction is commited on exit, or rolled back if an exception occured.
+
+        """
+        try:
+            db = self._pool.get(block=False)
+        except queue.Empty:
+            db = self.get_db()
+        try:
+            yield db
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put(db, block=False)
+            except queue.Full:
+                db.close()
+
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager borrowing a pooled database connection for direct writes.
+        Same as connection, but the writes count as storage activity (see idle_time),
+        use it for multi-statement writes that bypass the write-behind queue.
+
+        """
+        with self._worker_lock:
+            self._transactions += 1
+            self._last_put = time.time()
+        try:
+            with self.connection() as db:
+                yield db
+        finally:
+            with self._worker_lock:
+                self._transactions -= 1
+                self._last_put = time.time()
+
+
     def query(self, query, values=()):
         """
-        Perform query in current database.
+        Perform query in current database and return the result.
+        Blocking wrapper around submit, the query sees all previously queued writes.
+        Reads are performed directly in the calling thread, unless it has uncommited queued writes.
+
+        Arguments:
+            query   --- SQL query.
+
+        Keyworded arguments:
+            values  --- Values to substitute in the query.
+
+        """
+        if threading.current_thread() is self._worker or self._is_direct_read(query):
+            return self._read(query, values)
+        return self.submit(query, values).result()
+
+
+    def submit(self, query, values=()):
+        """
+        Submit query and return Future.
+        The Future result is the list of fetched rows, the query is executed after all previously queued writes.
+        Reads are performed by a pool of reader threads, unless the calling thread has uncommited queued writes.
+        Other queries are performed by the database worker thread.
+
+        Arguments:
+            query   --- SQL query.
+
+        Keyworded arguments:
+            values  --- Values to substitute in the query.
+
+        """
+        if self._is_direct_read(query):
+            with self._worker_lock:
+                if self._readers is None:
+                    self._readers = ThreadPoolExecutor(self.pool_size)
+                return self._readers.submit(self._read, query, values, self._caller(), time.time())
+        future = Future()
+        self._put((query, values, future))
+        return future
+
+
+    def write(self, query, values=()):
+        """
+        Queue a write query to be commited in the background.
+        Queued writes are commited in batches in a single transaction, use flush if you need to read them back.
+
+        Arguments:
+            query   --- SQL query.
+
+        Keyworded arguments:
+            values  --- Values to substitute in the query.
+
+        """
+        self._put((query, values, None))
+
+
+    def flush(self, timeout=None):
+        """
+        Wait until all queued writes are commited.
+        Return False if the timeout has expired.
+
+        Keyworded arguments:
+            timeout --- Maximum number of seconds to wait.
+
+        """
+        with self._worker_lock:
+            if self._worker is None:
+                return True
+            self._start_worker()
+        barrier = threading.Event()
+        self._jobs.put((self._NORMAL, next(self._sequence), barrier))
+        barrier.wait(timeout)
+        return barrier.is_set()
+
+
+    def get_lock(self, name):
+        """
+        Get lock for serializing multi-statement operations of the plugin.
+        Single statements do not need any locking.
+
+        Arguments:
+            name        --- Name of the lock (usually the plugin name).
+
+        """
+        with self._worker_lock:
+            if name not in self._locks:
+                self._locks[name] = threading.RLock()
+            return self._locks[name]
+
+
+    def migrate(self, name, migrations):
+        """
+        Upgrade schema of the plugin to the latest version.
+        Applies the migrations not yet recorded in schema_versions table, each one in its own transaction.
+        Returns the new schema version.
+
+        Arguments:
+            name        --- Name of the schema (usually the plugin name).
+            migrations  --- Sequence of migrations, the migration is an SQL statement or a sequence of them.
+                            Version N of the schema is the result of applying the first N migrations.
+
+        """
+        self.flush()
+        with self._migration_lock:
+            with self.connection() as db:
+                db.execute("""CREATE TABLE IF NOT EXISTS schema_versions (
+                                name VARCHAR(256) NOT NULL PRIMARY KEY,
+                                version INTEGER NOT NULL)""")
+                row = db.execute("SELECT version FROM schema_versions WHERE name=?", (name,)).fetchone()
+            version = 0 if row is None else int(row[0])
+
+            for number, migration in enumerate(migrations[version:], version + 1):
+                log.info(_("Migrating schema {!r} to version {}.").format(name, number))
+                if isinstance(migration, str):
+                    migration = (migration,)
+                with self.connection() as db:
+                    for statement in migration:
+                        db.execute(statement)
+                    db.execute("INSERT OR REPLACE INTO schema_versions (name, version) VALUES(?,?)", (name, number))
+                version = number
+        return version
+
+
+    def explain(self, query, values=()):
+        """
+        Return query plan of the query as a list of strings.
 
         Arguments:
             query   --- SQL query.
@@ -62,8 +393,238 @@ class Storage:
             values  --- Values to substitute in the query.
 
         """
-        db = self.get_db()
-        result = db.cursor().execute(query, values).fetchall()
-        db.commit()
-        db.close()
-        return result
\ No newline at end of file
+        with self.connection() as db:
+            return [row[-1] for row in sqlite3.Cursor(db).execute("EXPLAIN QUERY PLAN " + query, values).fetchall()]
+
+
+    def idle_time(self):
+        """
+        Return number of seconds since the last write, 0 if there are uncommited writes.
+        Counts the queued writes and the transactions, not the writes on connections borrowed by connection.
+
+        """
+        if len(self._pending) > 0 or self._transactions > 0:
+            return 0
+        return time.time() - self._last_put
+
+
+    def get_stats(self, limit=None, key="total"):
+        """
+        Return statistics of the executed statements as a list of QueryStats, the most expensive first.
+
+        Keyworded arguments:
+            limit   --- Maximum number of returned items.
+            key     --- Name of QueryStats attribute to sort by.
+
+        """
+        with self._stats_lock:
+            stats = sorted(self._stats.values(), key=lambda item: getattr(item, key), reverse=True)
+        return stats[:limit]
+
+
+    def reset_stats(self):
+        """
+        Forget statistics of the executed statements.
+
+        """
+        with self._stats_lock:
+            self._stats = {}
+
+
+    def close(self):
+        """
+        Close all pooled connections.
+
+        """
+        while True:
+            try:
+                self._pool.get(block=False).close()
+            except queue.Empty:
+                break
+
+
+    def shutdown(self):
+        """
+        Commit queued writes, stop the writer thread and close connections.
+
+        """
+        with self._worker_lock:
+            worker = self._worker
+            self._worker = None
+            readers = self._readers
+            self._readers = None
+        if worker is not None:
+            self._jobs.put((self._LAST, next(self._sequence), None))
+            worker.join()
+        if readers is not None:
+            readers.shutdown()
+        self.close()
+
+
+    def _is_direct_read(self, query):
+        """ Test if the query is a read, that can bypass the worker thread """
+        return threading.current_thread().ident not in self._pending and query.lstrip()[:6].upper() == "SELECT"
+
+
+    def _read(self, query, values, source=None, queued=None):
+        """ Perform read query on a pooled connection """
+        self._context.source = source
+        self._context.queued = queued
+        try:
+            with self.connection() as db:
+                return db.execute(query, values).fetchall()
+        finally:
+            self._context.source = None
+
+
+    def _caller(self):
+        """ Return the name of the module calling storage """
+        frame = sys._getframe(1)
+        while frame is not None:
+            name = frame.f_globals.get("__name__")
+            if name not in (__name__, "contextlib"):
+                return name
+            frame = frame.f_back
+        return None
+
+
+    def _record(self, query, elapsed, rows):
+        """ Record the statement execution in statistics, return QueryStats """
+        source = getattr(self._context, "source", None)
+        wait = 0.0
+        if source is None:
+            source = self._caller()
+        elif self._context.queued is not None:
+            # Count the wait only once per job
+            wait = time.time() - elapsed - self._context.queued
+            self._context.queued = None
+        normalized = self._normalized.get(query)
+        if normalized is None:
+            if len(self._normalized) >= self._max_normalized:
+                self._normalized = {}
+            normalized = self._normalized[query] = self._normalize_re.sub("?", " ".join(query.split()))
+        query = normalized
+        with self._stats_lock:
+            stats = self._stats.get((source, query))
+            if stats is None:
+                stats = self._stats[(source, query)] = QueryStats(source, query)
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.wait += max(0.0, wait)
+            stats.rows += rows
+        return stats
+
+
+    def _put(self, job):
+        """
+        Put job in the queue, start the worker thread if needed.
+        Jobs with a future of threads without other queued jobs are urgent, they skip the queued writes
+        and do not count in the backlog. The other jobs keep their order.
+
+        """
+        ident = threading.current_thread().ident
+        with self._worker_lock:
+            self._start_worker()
+            priority = self._URGENT if job[2] is not None and ident not in self._pending else self._NORMAL
+            self._pending[ident] = self._pending.get(ident, 0) + 1
+            self._last_put = time.time()
+        if priority == self._NORMAL:
+            # Outside of the lock, the backlog may be full
+            self._backlog.acquire()
+        self._jobs.put((priority, next(self._sequence), job + (ident, self._caller(), time.time())))
+
+
+    def _start_worker(self):
+        """ Start the worker thread if it's not running (or died), must be called with _worker_lock held """
+        if self._worker is not None and self._worker.is_alive():
+            return
+        if self._worker is not None:
+            log.error(_("Storage worker died, starting a new one."))
+        self._worker = threading.Thread(target=self._worker_loop, name="storage_worker")
+        self._worker.daemon = True
+        self._worker.start()
+
+
+    def _worker_loop(self):
+        """ Execute queued jobs, commit writes in batches """
+        log.debug(_("Entering storage worker loop."))
+        running = True
+        while running:
+            priority, sequence, job = self._jobs.get()
+            jobs = []
+            barriers = []
+            normal = 0
+            deadline = time.time() + self.delay
+            while True:
+                if job is None:
+                    running = False
+                    break
+                elif isinstance(job, threading.Event):
+                    barriers.append(job)
+                    break
+                jobs.append(job)
+                if priority == self._NORMAL:
+                    normal += 1
+                if job[2] is not None or len(jobs) >= self.batch:
+                    # Somebody waits for the result, or the batch is full
+                    break
+                try:
+                    priority, sequence, job = self._jobs.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+
+            try:
+                if len(jobs) > 0:
+                    self._execute_jobs(jobs)
+            except Exception:
+                log.exception(_("Execution of {} queued queries FAILED.").format(len(jobs)))
+            finally:
+                with self._worker_lock:
+                    for job in jobs:
+                        self._pending[job[3]] -= 1
+                        if self._pending[job[3]] == 0:
+                            del self._pending[job[3]]
+                for i in range(normal):
+                    self._backlog.release()
+                for barrier in barriers:
+                    barrier.set()
+        log.debug(_("Exiting storage worker loop."))
+
+
+    def _execute_jobs(self, jobs):
+        """ Execute the jobs in a single transaction and resolve their futures """
+        results = []
+        try:
+            with self.connection() as db:
+                for query, values, future, ident, source, queued in jobs:
+                    if future is not None and not future.set_running_or_notify_cancel():
+                        continue
+                    self._context.source = source
+                    self._context.queued = queued
+                    try:
+                        rows = db.execute(query, values).fetchall()
+                    except Exception as e:
+                        if future is None:
+                            log.exception(_("Queued query {!r} FAILED.").format(query))
+                        else:
+                            results.append((future, None, e))
+                        continue
+                    if future is not None:
+                        results.append((future, rows, None))
+            log.debug(_("Commited {} queued queries.").format(len(jobs)))
+        except Exception as e:
+            log.exception(_("Commit of {} queued queries FAILED.").format(len(jobs)))
+            results = [(future, None, e) for future, rows, error in results]
+            # Jobs not reached before the failure
+            resolved = set(id(future) for future, rows, error in results)
+            for job in jobs:
+                if job[2] is not None and id(job[2]) not in resolved and not job[2].done():
+                    results.append((job[2], None, e))
+        finally:
+            self._context.source = None
+        for future, rows, error in results:
+            if error is None:
+                future.set_result(rows)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Query plan checks: hot queries of the plugins must not scan whole tables.
+
+Run from the repository root:
+    python -m unittest discover tests
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import ast
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+gettext.install("keelsbot")
+
+from storage import Storage
+
+
+def load_plugin(name):
+    """ Import the plugin module, or return None if it can't be imported here """
+    try:
+        return __import__("plugins.{}".format(name), fromlist=[name])
+    except (ImportError, AttributeError):
+        return None
+
+
+def load_migrations(name):
+    """ Return Storage.migrations of the plugin, read from the source without importing the plugin """
+    with open(os.path.join(ROOT, "plugins", "{}.py".format(name)), encoding="utf-8") as fp:
+        tree = ast.parse(fp.read())
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == "Storage":
+            for item in node.body:
+                if isinstance(item, ast.Assign) and [target.id for target in item.targets if isinstance(target, ast.Name)] == ["migrations"]:
+                    return ast.literal_eval(item.value)
+    raise ValueError("Plugin {} has no Storage.migrations.".format(name))
+
+
+seen = load_plugin("seen")
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = Storage(os.path.join(self.directory, "keelsbot.sqlite"))
+
+    def tearDown(self):
+        self.store.shutdown()
+        shutil.rmtree(self.directory)
+
+    def assertNoScan(self, query, values=(), temp_btree=False):
+        """ Fail if the plan of the query contains full table scan (or temporary B-tree, unless allowed) """
+        plan = self.store.explain(query, values)
+        for detail in plan:
+            self.assertFalse(detail.startswith("SCAN"), "{!r} scans a table: {}".format(query, plan))
+            if not temp_btree:
+                self.assertNotIn("TEMP B-TREE", detail, "{!r} sorts in a temporary B-tree: {}".format(query, plan))
+
+
+class SeenQueryPlanTest(QueryPlanTestCase):
+    def setUp(self):
+        QueryPlanTestCase.setUp(self)
+        self.store.migrate("seen", load_migrations("seen"))
+
+    def test_get_records(self):
+        self.assertNoScan("SELECT event, timestamp, text FROM seen WHERE room=? AND nick=?", ("room", "nick"))
+
+    def test_search_candidates(self):
+        # Ranking of candidates by the number of common trigrams sorts only the matched postings
+        self.assertNoScan("SELECT normalized FROM seen_trigrams WHERE trigram IN (?,?,?) GROUP BY normalized ORDER BY COUNT(*) DESC LIMIT ?", ("  n", " ni", "nic", 50), temp_btree=True)
+
+    def test_search_nicks(self):
+        self.assertNoScan("SELECT room, nick FROM seen_nicks WHERE normalized IN (?,?)", ("nick", "nicks"))
+
+    def test_unindex(self):
+        # Statements of the seen_unindex trigger, run for every expired record
+        self.assertNoScan("SELECT 1 FROM seen WHERE room=? AND nick=?", ("room", "nick"))
+        self.assertNoScan("DELETE FROM seen_trigrams WHERE normalized=(SELECT normalized FROM seen_nicks WHERE room=? AND nick=?) AND NOT EXISTS (SELECT 1 FROM seen_nicks WHERE normalized=seen_trigrams.normalized AND (room!=? OR nick!=?))", ("room", "nick", "room", "nick"))
+        self.assertNoScan("DELETE FROM seen_nicks WHERE room=? AND nick=?", ("room", "nick"))
+
+    @unittest.skipIf(seen is None, "seen plugin can't be imported")
+    def test_retention_prunes_index(self):
+        with self.store.connection() as db:
+            db.executemany("INSERT INTO seen VALUES (?,?,?,?,?)", [("room", "Nick", 0, 1, None), ("other", "Nick", 0, 2, None), ("room", "Foo", 0, 3, None)])
+            seen.Storage.index_nicks(db, [("room", "Nick"), ("other", "Nick"), ("room", "Foo")])
+        self.store.query("DELETE FROM seen WHERE timestamp<?", (3,))
+        self.assertEqual([tuple(row) for row in self.store.query("SELECT room, nick FROM seen_nicks")], [("room", "Foo")])
+        self.assertEqual([tuple(row) for row in self.store.query("SELECT DISTINCT normalized FROM seen_trigrams")], [(seen.normalize("Foo"),)])
+
+
+class FeedsQueryPlanTest(QueryPlanTestCase):
+    def setUp(self):
+        QueryPlanTestCase.setUp(self)
+        self.store.migrate("feedreader", load_migrations("feedreader"))
+
+    def test_get(self):
+        self.assertNoScan("SELECT item FROM feeds WHERE feed=?", ("url",))
+
+    def test_prune(self):
+        self.assertNoScan("DELETE FROM feeds WHERE feed=? AND item IN (SELECT item FROM feeds WHERE feed=? ORDER BY timestamp DESC LIMIT -1 OFFSET 500)", ("url", "url"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Seen plugin storage checks.
+
+Run from the repository root:
+    python -m unittest discover tests
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+gettext.install("keelsbot")
+
+from storage import Storage
+
+try:
+    from plugins import seen
+except ImportError:
+    seen = None
+
+
+@unittest.skipIf(seen is None, "seen plugin can't be imported")
+class RetentionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = Storage(os.path.join(self.directory, "keelsbot.sqlite"))
+        self.seen = seen.Storage(self.store, interval=3600, retention=30)
+
+    def tearDown(self):
+        self.seen.shutdown()
+        self.store.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_expire_drops_cached_records(self):
+        old = int(time.time()) - 60 * 86400
+        self.seen.update("room", "Old", "message", "hello")
+        self.seen.update("room", "New", "message", "hi")
+        self.seen.dirty[("room", "Old", 0)] = (old, "hello")
+        self.seen.flush()
+        self.assertEqual(self.seen.get("room", "Old")[0], old)
+        self.assertIsNotNone(self.seen.get("room", "New"))
+
+        self.seen.expire()
+        self.assertIsNone(self.seen.get("room", "Old"))
+        self.assertIsNotNone(self.seen.get("room", "New"))
+        self.seen.flush()
+        self.assertEqual([tuple(row) for row in self.store.query("SELECT nick FROM seen")], [("New",)])
+        self.assertEqual([tuple(row) for row in self.store.query("SELECT nick FROM seen_nicks")], [("New",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
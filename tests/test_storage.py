@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Storage write path checks.
+
+Run from the repository root:
+    python -m unittest discover tests
+
+"""
+
+__author__ = "Petr Morávek (xificurk@gmail.com)"
+__copyright__ = ["Copyright (C) 2009-2011 Petr Morávek"]
+__license__ = "GPL 3.0"
+
+from contextlib import contextmanager
+import gettext
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+gettext.install("keelsbot")
+
+from storage import Storage
+
+
+@contextmanager
+def silent_log():
+    """ Silence the expected error messages of the storage """
+    logger = logging.getLogger("storage")
+    logger.disabled = True
+    try:
+        yield
+    finally:
+        logger.disabled = False
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = Storage(os.path.join(self.directory, "keelsbot.sqlite"))
+        self.store.migrate("test", ("CREATE TABLE test (value INTEGER NOT NULL)",))
+
+    def tearDown(self):
+        self.store.shutdown()
+        shutil.rmtree(self.directory)
+
+    def count(self):
+        return self.store.query("SELECT COUNT(*) FROM test")[0][0]
+
+
+class WriteBehindTest(StorageTestCase):
+    def test_flush(self):
+        for i in range(10):
+            self.store.write("INSERT INTO test (value) VALUES(?)", (i,))
+        self.assertTrue(self.store.flush(5))
+        self.assertEqual(self.count(), 10)
+
+    def test_shutdown_commits_queued_writes(self):
+        for i in range(10):
+            self.store.write("INSERT INTO test (value) VALUES(?)", (i,))
+        self.store.shutdown()
+        self.store = Storage(self.store.filename)
+        self.assertEqual(self.count(), 10)
+
+    def test_worker_survives_errors(self):
+        with self.assertRaises(OverflowError):
+            self.store.query("INSERT INTO test (value) VALUES(?)", (2 ** 70,))
+        with silent_log():
+            self.store.write("INSERT INTO test (value) VALUES(?)", (2 ** 70,))
+            self.store.write("INSERT INTO test (value) VALUES(?)", (1,))
+            self.assertTrue(self.store.flush(5))
+        self.assertEqual(self.count(), 1)
+
+    def test_dead_worker_is_restarted(self):
+        self.store.write("INSERT INTO test (value) VALUES(?)", (1,))
+        self.assertTrue(self.store.flush(5))
+        # Stop the worker behind the back of the storage, as if it died
+        self.store._jobs.put((Storage._LAST, next(self.store._sequence), None))
+        self.store._worker.join(5)
+        self.assertFalse(self.store._worker.is_alive())
+        with silent_log():
+            self.store.write("INSERT INTO test (value) VALUES(?)", (2,))
+            self.assertTrue(self.store.flush(5))
+        self.assertEqual(self.count(), 2)
+
+
+class StatsTest(StorageTestCase):
+    def setUp(self):
+        StorageTestCase.setUp(self)
+        self.store.reset_stats()
+
+    def stats(self, prefix):
+        return [item for item in self.store.get_stats() if item.query.startswith(prefix)]
+
+    def test_literals_are_normalized(self):
+        self.store.query("INSERT INTO test (value) VALUES(1)")
+        self.store.query("INSERT  INTO test (value)\n VALUES(25)")
+        stats = self.stats("INSERT")
+        self.assertEqual([item.query for item in stats], ["INSERT INTO test (value) VALUES(?)"])
+        self.assertEqual(stats[0].count, 2)
+
+    def test_source_of_queued_writes(self):
+        for i in range(3):
+            self.store.write("INSERT INTO test (value) VALUES(?)", (i,))
+        self.assertTrue(self.store.flush(5))
+        stats = self.stats("INSERT")
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0].source, stats[0].count, stats[0].rows), (__name__, 3, 3))
+
+    def test_fetched_rows(self):
+        self.store.query("INSERT INTO test (value) VALUES(?)", (1,))
+        self.store.query("INSERT INTO test (value) VALUES(?)", (2,))
+        self.assertEqual(self.count(), 2)
+        stats = self.stats("SELECT")
+        self.assertEqual((stats[0].count, stats[0].rows), (1, 1))
+        self.store.query("SELECT value FROM test")
+        self.assertEqual(self.stats("SELECT value")[0].rows, 2)
+
+    def test_executemany_stats(self):
+        with self.store.transaction() as db:
+            db.executemany("INSERT INTO test (value) VALUES(?)", [(1,), (2,), (3,)])
+        stats = self.stats("INSERT")
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0].count, stats[0].rows), (1, 3))
+
+    def test_reset_stats(self):
+        self.store.query("INSERT INTO test (value) VALUES(?)", (1,))
+        self.assertNotEqual(self.store.get_stats(), [])
+        self.store.reset_stats()
+        self.assertEqual(self.store.get_stats(), [])
+
+
+class StorageTest(StorageTestCase):
+    def test_transaction_is_activity(self):
+        self.store._last_put = time.time() - 100
+        self.assertGreaterEqual(self.store.idle_time(), 100)
+        with self.store.transaction() as db:
+            db.executemany("INSERT INTO test (value) VALUES(?)", [(1,), (2,)])
+            self.assertEqual(self.store.idle_time(), 0)
+        self.assertLess(self.store.idle_time(), 100)
+        self.assertEqual(self.store.query("SELECT COUNT(*) FROM test")[0][0], 2)
+
+    def test_waited_query_skips_queued_writes(self):
+        self.store.shutdown()
+        self.store = Storage(os.path.join(self.directory, "keelsbot.sqlite"), batch=10)
+        for i in range(500):
+            self.store.write("INSERT INTO test (value) VALUES(?)", (i,))
+        counts = []
+        def query():
+            self.store.query("INSERT INTO test (value) VALUES(?)", (-1,))
+            counts.append(self.store.query("SELECT COUNT(*) FROM test")[0][0])
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join()
+        self.assertLess(counts[0], 501)
+        self.assertTrue(self.store.flush(5))
+        self.assertEqual(self.store.query("SELECT COUNT(*) FROM test")[0][0], 501)
+
+
+if __name__ == "__main__":
+    unittest.main()